@@ -1,22 +1,34 @@
+import hashlib
 import json
 import os.path
-import glob
+import random
+import threading
 import time
 import datetime
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import sentry_sdk
 from sentry_sdk.integrations.wsgi import SentryWsgiMiddleware
+from werkzeug.datastructures import MultiDict
 from werkzeug.wrappers import Request, Response
 from werkzeug.routing import Map, Rule
-from werkzeug.exceptions import HTTPException, NotFound, BadRequest
+from werkzeug.exceptions import HTTPException, NotFound, BadRequest, ServiceUnavailable
 from werkzeug.utils import redirect
 # from werkzeug.contrib.fixers import ProxyFix
 from werkzeug.middleware.proxy_fix import ProxyFix
-from requests import HTTPError
+from requests import HTTPError, RequestException
 from boto.s3.key import Key
 
+import prism.backends as backends
 import prism.core as core
+import prism.metrics as metrics
 import prism.settings as settings
+from prism.image import validate_filters
+from prism.janitor import TempDirJanitor
+from prism.render import RenderEngine, RenderProcessError, RenderTimeoutError
+from prism.singleflight import SingleFlight
+from prism.uploads import WriteBehindUploader
 
 
 logging.basicConfig(level=logging.WARNING)
@@ -24,6 +36,37 @@ logger = logging.getLogger(__name__)
 
 sentry_sdk.init()  # uses SENTRY_DSN env var
 
+render_flight = SingleFlight(lock_dir=settings.RENDER_LOCK_DIR, timeout=settings.RENDER_COALESCE_TIMEOUT)
+
+# Each worker renders with its own ImageMagick temporary directory, cleaned in the background
+tmp_janitor = None
+if settings.MAGICK_TMP_DIR:
+    tmp_janitor = TempDirJanitor(settings.MAGICK_TMP_DIR,
+                                 max_age=settings.MAGICK_TMP_MAX_AGE,
+                                 interval=settings.MAGICK_TMP_CLEAN_INTERVAL)
+    metrics.register_gauge('prism_magick_tmp_files', 'ImageMagick temporary files of this worker.',
+                           lambda: tmp_janitor.files)
+    metrics.register_gauge('prism_magick_tmp_bytes', 'Bytes of the ImageMagick temporary files of this worker.',
+                           lambda: tmp_janitor.bytes)
+    metrics.register_gauge('prism_magick_tmp_removed_files', 'Old ImageMagick temporary files removed by this worker.',
+                           lambda: tmp_janitor.removed_files)
+    metrics.register_gauge('prism_magick_tmp_removed_dirs', 'Temporary directories of dead workers removed by this worker.',
+                           lambda: tmp_janitor.removed_dirs)
+
+# With SERVE_ON_MISS rendered images are returned to the client right away and uploaded in the background
+uploader = None
+if settings.SERVE_ON_MISS:
+    uploader = WriteBehindUploader(threads=settings.UPLOAD_THREADS,
+                                   queue_size=settings.UPLOAD_QUEUE_SIZE,
+                                   retries=settings.UPLOAD_RETRIES)
+
+render_engine = None
+if settings.RENDER_PROCESSES:
+    render_engine = RenderEngine(processes=settings.RENDER_PROCESSES,
+                                 timeout=settings.RENDER_TIMEOUT,
+                                 max_jobs=settings.RENDER_MAX_JOBS_PER_PROCESS,
+                                 max_rss=settings.RENDER_MAX_RSS)
+
 
 class App(object):
 
@@ -37,6 +80,7 @@ class App(object):
             Rule('/favicon.ico', endpoint='not_found'),
             Rule('/robots.txt', endpoint='not_found'),
             Rule('/setdpr/<dpr>', endpoint='set_dpr'),
+            Rule('/metrics', endpoint='metrics'),
         ])
         self.credentials_store = credentials_store
 
@@ -58,7 +102,10 @@ class App(object):
             subdomain = request.host.split('.' + settings.DOMAIN)[0]
         with sentry_sdk.configure_scope() as scope:
             scope.set_tag("customer", subdomain)
-        customer = self.credentials_store.get_customer(subdomain)
+        with metrics.timer('customer'):
+            customer = self.credentials_store.get_customer(subdomain)
+        # only known customers are labels, so clients can't create new metrics
+        metrics.set_labels(customer=self.credentials_store.get_customer_label(subdomain))
         return customer
 
     def main(self, request):
@@ -66,13 +113,25 @@ class App(object):
         _, extension = os.path.splitext(path.lower())
         if extension not in ('.png', '.jpg', '.jpeg', '.gif', '.webp', ''):
             raise NotFound()
+        if request.args.get('cmd') == 'batch':
+            metrics.set_labels(command='batch')
+            try:
+                with metrics.timer('parse'):
+                    variants = parse_batch_args(path, request)
+            except Exception as e:
+                raise BadRequest(e)
+            return batch(path, variants, self.get_customer(request))
+
         try:
-            args = parse_args(path, request)
+            with metrics.timer('parse'):
+                args = parse_args(path, request)
         except Exception as e:
             raise BadRequest(e)
+        metrics.set_labels(command=args['command'])
 
         customer = self.get_customer(request)
-        if extension == '.gif' and request.args.get('out', 'gif') == 'gif':
+        animated = settings.RESIZE_GIFS and args['options']['out_format'] == 'webp'
+        if extension == '.gif' and request.args.get('out', 'gif') == 'gif' and not animated:
             s3_url = core.get_s3_url(
                 customer.read_bucket_name,
                 customer.read_bucket_region,
@@ -130,6 +189,13 @@ class App(object):
         }
         return process(settings.TEST_IMAGE, args, customer)
 
+    def metrics(self, request):
+        # the address of the connection, not one taken from a X-Forwarded-For header a client can set
+        remote_addr = request.environ.get('werkzeug.proxy_fix.orig', request.environ).get('REMOTE_ADDR')
+        if remote_addr not in settings.METRICS_ALLOWED_IPS:
+            raise NotFound()
+        return Response(metrics.render_prometheus(), content_type='text/plain; version=0.0.4')
+
     def set_dpr(self, request, dpr):
         expires = datetime.datetime.utcnow() + datetime.timedelta(days=365)
         response = Response('var prism_dpr_set=%s;' % dpr, content_type='application/javascript')
@@ -138,7 +204,11 @@ class App(object):
 
     def wsgi_app(self, environ, start_response):
         request = Request(environ)
+        metrics.start_request()
         response = self.dispatch_request(request)
+        timings = metrics.finish_request()
+        if timings and isinstance(response, Response):
+            response.headers['Server-Timing'] = metrics.server_timing_header(timings)
         return response(environ, start_response)
 
     def __call__(self, environ, start_response):
@@ -152,19 +222,33 @@ def info(path, args, customer):
         path,
         endpoint=customer.read_bucket_endpoint_url)
     try:
-        im = core.fetch_image(url)
+        info = core.fetch_info(url)
     except HTTPError as e:
         if e.response.status_code in (404, 403):
             raise NotFound()
         else:
             raise
-    info = core.info(im)
+    except core.EmptyOriginalFile as e:
+        raise BadRequest(e.message)
+    except core.InvalidImageError as e:
+        raise BadRequest(e.message)
+    except core.OriginalTooLargeError as e:
+        raise BadRequest(e.message)
     return json_response(info)
 
 
-def fetch_image(original_url):
+def decode_original(data, size_hint=None):
+    try:
+        return core.decode_image(data, size_hint=size_hint)
+    except core.InvalidImageError as e:
+        raise BadRequest(e.message)
+    except core.OriginalTooLargeError as e:
+        raise BadRequest(e.message)
+
+
+def fetch_original(original_url):
     try:
-        return core.fetch_image(original_url)
+        return core.download_original(original_url)
     except HTTPError as e:
         if e.response.status_code in (404, 403):
             raise NotFound()
@@ -172,39 +256,148 @@ def fetch_image(original_url):
             raise
     except core.EmptyOriginalFile as e:
         raise BadRequest(e.message)
-    except core.InvalidImageError as e:
+    except core.OriginalFileTooLargeError as e:
         raise BadRequest(e.message)
 
 
+def render(original_url, cmd, options, customer, result_path, result_url, size_hint=None, with_original=False):
+    """
+    Renders the derivative from the original and uploads it to the write bucket.
+    Returns the rendered bytes and the info of the original. The info is read from the decoded
+    original if with_original is set, otherwise from its headers (and may be None).
+    """
+    start_tmp_janitor()
+    original, source_etag = fetch_original(original_url)
+    original_info = None
+    if with_original:
+        im = decode_original(original, size_hint=size_hint)
+        f = core.resize(im.clone(), cmd, options)
+        original_info = core.info(im)
+    else:
+        data = original
+        try:
+            if render_engine is not None:
+                with metrics.timer('render'):
+                    f = render_engine.render(data, cmd, options, size_hint=size_hint, backend=customer.render_backend)
+            else:
+                f, _ = backends.render(data, cmd, options, size_hint=size_hint, backend=customer.render_backend)
+        except (core.InvalidImageError, core.OriginalTooLargeError, backends.UnsupportedGifOptionsError) as e:
+            raise BadRequest(e.message)
+        except (RenderTimeoutError, RenderProcessError) as e:
+            raise ServiceUnavailable(e.message)
+        if settings.RESULT_INFO:
+            original_info = get_original_info(original)
+    data = f.getvalue()
+    info = core.make_result_info(source_etag, data, original_info) if settings.RESULT_INFO else None
+    upload = partial(core.upload_file, customer.write_bucket_name, get_write_s3_config(customer),
+                     new_filename=result_path, url=result_url, info=info)
+    if uploader is not None:
+        uploader.upload(result_url, data, upload)
+    else:
+        upload(f)
+    return data, original_info
+
+
+def get_original_info(original, im=None):
+    """
+    Returns the info of the original from its headers, which is cheap and has the full size of
+    JPEGs decoded at a reduced scale. Other formats are read from the decoded image if it is given,
+    otherwise their info is None.
+    """
+    try:
+        original_info = core.header_info(original)
+    except core.UnsupportedHeaderError:
+        original_info = None
+    if original_info is None and im is not None:
+        original_info = core.info(im)
+    return original_info
+
+
+def get_write_s3_config(customer):
+    return core.S3ConnectionConfig(
+        key_id=customer.write_bucket_key_id,
+        region=customer.write_bucket_region,
+        secret_key=customer.write_bucket_secret_key,
+        endpoint_url=customer.write_bucket_endpoint_url,
+    )
+
+
+def find_existing_result(path, cmd, options, customer, result_url):
+    """
+    Returns the url of the rendered derivative if it already exists, or None.
+    With DERIVATIVE_KEY_LEGACY_FALLBACK, derivatives stored under their legacy key are found too.
+    """
+    if core.check_s3_object_exists(result_url, cache=core.result_exists_cache):
+        return result_url
+    if settings.DERIVATIVE_KEY_LEGACY_FALLBACK:
+        legacy_path = core.get_thumb_filename(path, cmd, options, key_format='legacy')
+        legacy_url = core.get_s3_url(customer.write_bucket_name, customer.write_bucket_region, legacy_path, endpoint=customer.write_bucket_endpoint_url)
+        if legacy_url != result_url and core.check_s3_object_exists(legacy_url, cache=core.result_exists_cache):
+            return legacy_url
+    return None
+
+
 def process(path, args, customer):
     cmd = args['command']
     options = args['options']
     original_url = core.get_s3_url(customer.read_bucket_name, customer.read_bucket_region, path, endpoint=customer.read_bucket_endpoint_url)
     if args['debug']:
-        im = core.fetch_image(original_url)
+        im = core.fetch_image(original_url, size_hint=core.get_decode_size_hint(cmd, options))
         f = core.resize(im, cmd, options)
         r = Response(f, mimetype='image/jpeg')
         return r
     result_path = core.get_thumb_filename(path, cmd, options)
     result_url = core.get_s3_url(customer.write_bucket_name, customer.write_bucket_region, result_path, endpoint=customer.write_bucket_endpoint_url)
-    exists = core.check_s3_object_exists(result_url)
-    if args['with_info'] or args['force'] or not exists:
-        clear_old_tmp_files()
-        im = fetch_image(original_url=original_url)
-        f = core.resize(im.clone(), cmd, options)
-        bucket_name = customer.write_bucket_name
-        s3_config = core.S3ConnectionConfig(
-            key_id=customer.write_bucket_key_id,
-            region=customer.write_bucket_region,
-            secret_key=customer.write_bucket_secret_key,
-            endpoint_url=customer.write_bucket_endpoint_url,
+    if args['with_info']:
+        result_info = None
+        if settings.RESULT_INFO and not args['force']:
+            result_info = core.get_result_info(result_url)
+        if result_info and result_info.get('original'):
+            info = result_info['original']
+        else:
+            _, info = render(original_url, cmd, options, customer, result_path, result_url, with_original=True)
+        info['url'] = result_url
+        return json_response(info)
+    # Hot derivatives are answered from the cache shared by the workers on this host without any request to S3
+    hot = False
+    if core.hot_cache is not None:
+        if args['force']:
+            core.hot_cache.discard(result_url)
+        else:
+            hot = core.hot_requests.increment(result_url) >= settings.HOT_CACHE_MIN_REQUESTS
+            cached = get_hot_result(result_url)
+            if cached is not None:
+                data, url = cached
+                return image_response(data, result_path) if data else redirect_to_result(url, args['no_redirect'])
+    if uploader is not None and not args['force']:
+        data = uploader.get_pending(result_url)
+        if data is not None:
+            return image_response(data, result_path)
+    existing_url = None if args['force'] else find_existing_result(path, cmd, options, customer, result_url)
+    if existing_url:
+        if hot:
+            data = cache_hot_result(result_url, existing_url)
+            if data:
+                return image_response(data, result_path)
+        result_url = existing_url
+    else:
+        # Concurrent requests for the same derivative wait for a single render
+        rendered = render_flight.do(
+            result_url,
+            partial(render, original_url, cmd, options, customer, result_path, result_url,
+                    size_hint=core.get_decode_size_hint(cmd, options)),
+            recheck=None if args['force'] else partial(core.check_s3_object_exists, result_url),
         )
-        core.upload_file(bucket_name, s3_config, f, result_path)
-        if args['with_info']:
-            info = core.info(im)
-            info['url'] = result_url
-            return json_response(info)
-    if args['no_redirect']:
+        if rendered is not None and hot:
+            cache_hot_result(result_url, result_url, rendered[0])
+        if rendered is not None and settings.SERVE_ON_MISS:
+            data, _ = rendered
+            return image_response(data, result_path)
+    return redirect_to_result(result_url, args['no_redirect'])
+
+
+def redirect_to_result(result_url, no_redirect=False):
+    if no_redirect:
         r = Response()
         # Tell nginx to serve the url for us
         # https://www.nginx.com/resources/wiki/start/topics/examples/x-accel/#x-accel-redirect
@@ -214,6 +407,80 @@ def process(path, args, customer):
         return redirect(result_url)
 
 
+def get_hot_result(result_url):
+    """
+    Returns the (data, url) of a derivative in the hot cache or None. The data is empty for derivatives
+    too large to cache, which are redirected to without checking that they exist.
+    """
+    cached = core.hot_cache.get(result_url)
+    if cached is None:
+        return None
+    metadata, data = cached
+    if metadata.get('expires', 0) < time.time():
+        return None
+    return data, metadata.get('url', result_url)
+
+
+def cache_hot_result(result_url, url, data=None):
+    """
+    Adds a derivative stored at url to the hot cache, downloading it unless its data is given.
+    Returns the data if it was cached.
+    """
+    max_bytes = settings.HOT_CACHE_MAX_ITEM_BYTES
+    if data is None:
+        try:
+            data = core.download_result(url, max_bytes=max_bytes)
+        except RequestException:
+            logger.warning("Failed to download %s for the hot cache", url, exc_info=True)
+            return None
+    if data is not None and len(data) > max_bytes:
+        data = None
+    core.hot_cache.put(result_url, data or b'', {'url': url, 'expires': time.time() + settings.HOT_CACHE_TTL})
+    return data
+
+
+def batch(path, variants, customer):
+    """
+    Renders several derivatives of the same original, downloading and decoding it only once.
+    Variants are rendered largest first and uploaded in parallel.
+    """
+    original_url = core.get_s3_url(customer.read_bucket_name, customer.read_bucket_region, path, endpoint=customer.read_bucket_endpoint_url)
+    results = []
+    jobs = []
+    for args in variants:
+        cmd = args['command']
+        options = args['options']
+        result_path = core.get_thumb_filename(path, cmd, options)
+        result_url = core.get_s3_url(customer.write_bucket_name, customer.write_bucket_region, result_path, endpoint=customer.write_bucket_endpoint_url)
+        if args['force'] and core.hot_cache is not None:
+            core.hot_cache.discard(result_url)
+        existing_url = None if args['force'] else find_existing_result(path, cmd, options, customer, result_url)
+        results.append({'url': existing_url or result_url})
+        if not existing_url:
+            jobs.append((cmd, options, result_path, result_url))
+
+    if jobs:
+        start_tmp_janitor()
+        jobs.sort(key=lambda job: max(job[1]['w'] or 0, job[1]['h'] or 0), reverse=True)
+        # the original can only be decoded at a reduced size if every variant allows it
+        size_hints = [core.get_decode_size_hint(cmd, options) for cmd, options, _, _ in jobs]
+        size_hint = None if None in size_hints else max(size_hints)
+        original, source_etag = fetch_original(original_url)
+        im = decode_original(original, size_hint=size_hint)
+        original_info = get_original_info(original, im) if settings.RESULT_INFO else None
+        s3_config = get_write_s3_config(customer)
+        with ThreadPoolExecutor(max_workers=settings.BATCH_UPLOAD_THREADS) as executor:
+            uploads = []
+            for cmd, options, result_path, result_url in jobs:
+                f = core.resize(im.clone(), cmd, options)
+                info = core.make_result_info(source_etag, f.getvalue(), original_info) if settings.RESULT_INFO else None
+                uploads.append(executor.submit(core.upload_file, customer.write_bucket_name, s3_config, f, result_path,
+                                               url=result_url, info=info))
+            for upload in uploads:
+                upload.result()
+    return json_response(results)
+
+
 def make_bool(x):
     if x.lower() in ('false', '0'):
         return False
@@ -245,9 +512,6 @@ def get_command(args):
 
 def get_dimensions(args, command):
     max_dimension = 10000
-    if args.get('premultiplied'):
-        # We use a smaller max_dimension in this case because convert_to_premultiplied_png needs to make an in-memory copy
-        max_dimension = 4000
     width = args.get('w', args.get('width', None))
     height = args.get('h', args.get('height', None))
     if width:
@@ -269,7 +533,7 @@ def get_dimensions(args, command):
     if command == 'resize':
         if not (width or height):
             raise Exception('width or height is required')
-    elif command in ('resize_then_crop', 'resize_then_fit'):
+    elif command in ('resize_then_crop', 'resize_then_fit', 'smart_crop'):
         if not (width and height):
             raise Exception('width and height is required')
     return width, height
@@ -306,9 +570,23 @@ def convert_filters_to_json(args):
             filters = json.loads(filters)
         except Exception:
             raise Exception("Error 108 - couldn't decode json")
+        try:
+            validate_filters(filters)
+        except ValueError as e:
+            raise Exception('Error 113 - %s' % e)
     return filters
 
 
+def get_quality(args):
+    quality = args.get('quality', '95')
+    if quality == 'auto':
+        return quality
+    try:
+        return int(quality)
+    except ValueError:
+        raise Exception('Error 112 - quality should be an integer or auto')
+
+
 def get_opacity(command, args):
     default_opacity = 100
     # this is to replicate a bug in the original version
@@ -319,8 +597,9 @@ def get_opacity(command, args):
     return default_opacity
 
 
-def parse_args(path, request):
-    args = request.args
+def parse_args(path, request, args=None):
+    if args is None:
+        args = request.args
     new_args = {}
     options = {}
 
@@ -347,7 +626,7 @@ def parse_args(path, request):
     options['frame_bg_color'] = args.get('frame_bg_color', 'FFF')
     options['gravity'] = args.get('gravity', 'center')
     options['premultiplied_alpha'] = args.get('premultiplied', None)
-    options['q'] = int(args.get('quality', '95'))
+    options['q'] = get_quality(args)
     options['opacity'] = get_opacity(command=command, args=args, )
     options['filters'] = convert_filters_to_json(args=args)
     options['out_format'] = get_output_format(default_out_format=extension[1:],
@@ -364,20 +643,55 @@ def parse_args(path, request):
     return new_args
 
 
+def parse_batch_args(path, request):
+    variants = request.args.get('variants', None)
+    try:
+        variants = json.loads(variants)
+    except Exception:
+        raise Exception("Error 109 - couldn't decode variants json")
+    if not isinstance(variants, list) or not variants or not all(isinstance(v, dict) for v in variants):
+        raise Exception('Error 110 - variants should be a list of parameter objects')
+    if len(variants) > settings.BATCH_MAX_VARIANTS:
+        raise Exception(f'Error 110 - at most {settings.BATCH_MAX_VARIANTS} variants can be rendered at once')
+    new_args = []
+    for variant in variants:
+        args = MultiDict()
+        for k, v in variant.items():
+            args[k] = v if isinstance(v, str) else json.dumps(v)
+        if args.get('cmd') == 'batch':
+            raise Exception('Error: parameter is wrong - command')
+        new_args.append(parse_args(path, request, args=args))
+    return new_args
+
+
 def json_response(data):
     return Response(json.dumps(data), content_type='application/json')
 
 
-def clear_old_tmp_files():
-    tmp_files = glob.glob('/tmp/magick-*')
-    now = time.time()
-    for tmp_file in tmp_files:
-        try:
-            if os.stat(tmp_file).st_mtime < now - 300:
-                os.remove(tmp_file)
-        except Exception:
-            # An error might occur if the file has already been deleted by another process. We don't care.
-            pass
+def get_mimetype(data, result_path):
+    """
+    Returns the mimetype of rendered image bytes. Premultiplied alpha renders are PNGs whatever
+    the extension of their key, so the extension is only used for formats that aren't recognised.
+    """
+    fmt = core.sniff_format(data)
+    if fmt:
+        return 'image/%s' % fmt.lower()
+    extension = result_path.rsplit('.', 1)[-1].lower()
+    return 'image/jpeg' if extension in ('jpg', 'jpeg') else 'image/%s' % extension
+
+
+def image_response(data, result_path):
+    r = Response(data, mimetype=get_mimetype(data, result_path))
+    # S3 uses the MD5 of the object as the ETag of a single part upload, so this matches later responses from S3
+    r.set_etag(hashlib.md5(data).hexdigest())
+    r.headers['Cache-Control'] = settings.RENDER_CACHE_CONTROL
+    return r
+
+
+def start_tmp_janitor():
+    # uwsgi forks the workers after importing the app, so each worker starts its janitor on first use
+    if tmp_janitor:
+        tmp_janitor.start()
 
 
 class Customer(object):
@@ -392,6 +706,7 @@ class Customer(object):
                  write_bucket_secret_key=None,
                  write_bucket_region=None,
                  write_bucket_endpoint_url=None,
+                 render_backend=None,
                  **kwargs):
         self.read_bucket_name = read_bucket_name
         self.read_bucket_key_id = read_bucket_key_id
@@ -403,42 +718,91 @@ class Customer(object):
         self.write_bucket_secret_key = write_bucket_secret_key or read_bucket_secret_key
         self.write_bucket_region = write_bucket_region or read_bucket_region
         self.write_bucket_endpoint_url = write_bucket_endpoint_url or read_bucket_endpoint_url
+        self.render_backend = render_backend
 
 
 class CredentialsStore(object):
-    def __init__(self, bucket: str, default_customer: str):
+    """
+    Loads customer credentials from credentials.json in the secrets bucket.
+
+    The first lookup loads the credentials. After that a background thread per worker reloads
+    them every `refresh_interval` seconds (plus or minus a random jitter so workers don't refresh
+    together) and swaps in a new map of Customer objects, so requests never wait for S3.
+    If a reload fails the previous credentials continue to be used.
+    """
+
+    def __init__(self, bucket: str, default_customer: str,
+                 refresh_interval=settings.CREDENTIALS_REFRESH_INTERVAL,
+                 refresh_jitter=settings.CREDENTIALS_REFRESH_JITTER):
         self.bucket_name = bucket
         self.default_customer = default_customer
+        self.refresh_interval = refresh_interval
+        self.refresh_jitter = refresh_jitter
         self.customers_credentials = {}
-        self.expiration_time = None
-
-    def _get_credentials(self):
-        if not self.customers_credentials or self.expiration_time < datetime.datetime.now():
-            logger.info('Loading credentials from %s', self.bucket_name)
-            # Get the credentials from the private secrets bucket.
-            # Boto authenticates using the IAM role assigned to the ec2 instances.
+        self.customers = {}
+        self.loaded_at = None
+        self.refresh_failures = 0
+        self._load_lock = threading.Lock()
+        self._refresher_pid = None
+        metrics.register_gauge('prism_credentials_age_seconds', 'Seconds since the credentials were loaded.',
+                               lambda: time.monotonic() - self.loaded_at if self.loaded_at else -1)
+        metrics.register_gauge('prism_credentials_refresh_failures', 'Failed reloads of the credentials.',
+                               lambda: self.refresh_failures)
+
+    def refresh(self):
+        logger.info('Loading credentials from %s', self.bucket_name)
+        # Get the credentials from the private secrets bucket.
+        # Boto authenticates using the IAM role assigned to the ec2 instances.
+        try:
+            s3_config = core.S3ConnectionConfig()
+            s3 = core.get_s3_client(s3_config)
+            bucket = s3.get_bucket(self.bucket_name, validate=False)
+            k = Key(bucket, 'credentials.json')
+            customers_credentials = json.loads(k.get_contents_as_string())
+            customers = {key: Customer(**credentials) for key, credentials in customers_credentials.items()}
+        except Exception:
+            logger.exception("Exception while getting customer credentials")
+            sentry_sdk.capture_exception()
+            # if we have a stale data continue to use it
+            # s3 may be unavailable or the new credentials may be unparsable
+            self.refresh_failures += 1
+            return
+        if self.customers_credentials and customers_credentials != self.customers_credentials:
+            # credentials were rotated, connections using the old keys must not be reused
+            core.clear_s3_client_cache()
+        self.customers_credentials = customers_credentials
+        self.customers = customers
+        self.loaded_at = time.monotonic()
+
+    def _refresh_forever(self):
+        while True:
             try:
-                s3_config = core.S3ConnectionConfig()
-                s3 = core.get_s3_client(s3_config)
-                bucket = s3.get_bucket(self.bucket_name, validate=False)
-                k = Key(bucket, 'credentials.json')
-                self.customers_credentials = json.loads(k.get_contents_as_string())
-                self.expiration_time = datetime.datetime.now() + datetime.timedelta(minutes=5)
+                time.sleep(max(0, self.refresh_interval + random.uniform(-self.refresh_jitter, self.refresh_jitter)))
+                self.refresh()
             except Exception:
-                logger.exception("Exception while getting customer credentials")
-                sentry_sdk.capture_exception()
-                # if we have a stale data continue to use it
-                # s3 may be unavailable or the new credentials may be unparsable
-                # so we extend the timeout by a minute instead of continuously requesting
-                # and waiting on every request
-                if self.customers_credentials:
-                    self.expiration_time += datetime.timedelta(minutes=1)
-                    return self.customers_credentials
-        return self.customers_credentials
+                # the thread isn't restarted, so it must never die
+                logger.exception("Exception in the credentials refresher")
+                time.sleep(1)
+
+    def _get_customers(self):
+        if not self.customers:
+            # Nothing to serve from yet, so load synchronously. Other threads wait for the same load.
+            with self._load_lock:
+                if not self.customers:
+                    self.refresh()
+        if self._refresher_pid != os.getpid():
+            # threads don't survive a fork, so each worker starts its own refresher
+            with self._load_lock:
+                if self._refresher_pid != os.getpid():
+                    self._refresher_pid = os.getpid()
+                    threading.Thread(target=self._refresh_forever, name='credentials-refresher', daemon=True).start()
+        return self.customers
 
     def get_customer(self, customer_key) -> Customer:
-        credentials = self._get_credentials()[customer_key]
-        return Customer(**credentials)
+        return self._get_customers()[customer_key]
+
+    def get_customer_label(self, customer_key):
+        return customer_key
 
     def get_default_customer(self):
         return self.get_customer(self.default_customer)
@@ -451,6 +815,10 @@ class SingleCustomerCredentialsStore(object):
     def get_customer(self, customer_key):
         return Customer(**self.credentials)
 
+    def get_customer_label(self, customer_key):
+        # any key gets the one customer, so keys must not become labels
+        return ''
+
     def get_default_customer(self):
         return self.get_customer(None)
 
@@ -0,0 +1,313 @@
+import logging
+import math
+from functools import partial
+from io import BytesIO
+
+import numpy
+
+from PIL import Image, ImageOps, ImageSequence, UnidentifiedImageError
+
+import prism.core as core
+import prism.metrics as metrics
+import prism.settings as settings
+
+logger = logging.getLogger(__name__)
+
+ORIENTATION_TAG = 0x0112
+
+
+class UnsupportedImageError(Exception):
+    """
+    Raised by a backend for an original it can't render, which is then rendered with ImageMagick.
+    """
+
+
+class UnsupportedGifOptionsError(Exception):
+    """
+    Raised for a GIF rendered to animated WebP with options the gif backend doesn't support.
+    """
+    message = 'Filters, crops, smart gravity and premultiplied alpha are not supported for GIFs.'
+
+
+class ImageMagickBackend(object):
+    """
+    Renders every command, format and filter with ImageMagick through ImageOperator.
+    """
+    name = 'imagemagick'
+
+    def supports(self, cmd, options):
+        return True
+
+    def render(self, data, cmd, options, size_hint=None) -> BytesIO:
+        im = core.decode_image(data, size_hint=size_hint)
+        return core.resize(im, cmd, options)
+
+
+class PillowBackend(object):
+    """
+    Renders plain resizes of JPEG, PNG and WebP originals to JPEG or WebP with Pillow.
+
+    Large JPEGs are decoded at 1/2, 1/4 or 1/8 scale with draft mode, and large downscales start
+    with reduce(), which averages blocks of pixels, before the final Lanczos resize.
+    The output geometry follows ImageOperator.resize.
+    """
+    name = 'pillow'
+    commands = ('resize', 'resize_then_crop', 'resize_then_fit')
+    input_formats = ('JPEG', 'PNG', 'WEBP')
+    input_modes = ('1', 'L', 'LA', 'P', 'RGB', 'RGBA')
+    output_formats = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'webp': 'WEBP'}
+
+    def supports(self, cmd, options):
+        return (cmd in self.commands
+                and options['out_format'] in self.output_formats
+                and not options.get('filters')
+                and not options.get('premultiplied_alpha')
+                and options.get('gravity') != 'smart'
+                and not any(options.get(k) for k in ('crop_x', 'crop_y', 'crop_width', 'crop_height')))
+
+    def render(self, data, cmd, options, size_hint=None) -> BytesIO:
+        with metrics.timer('decode'):
+            try:
+                img = Image.open(BytesIO(data))
+            except UnidentifiedImageError:
+                raise UnsupportedImageError('unknown format')
+            except Image.DecompressionBombError:
+                raise core.OriginalTooLargeError
+            if img.format not in self.input_formats or img.mode not in self.input_modes:
+                raise UnsupportedImageError('%s %s' % (img.format, img.mode))
+            is_jpeg = img.format == 'JPEG'
+            too_large = settings.MAX_ORIGINAL_PIXELS and img.width * img.height > settings.MAX_ORIGINAL_PIXELS
+            if too_large and not is_jpeg:
+                # only JPEGs can be decoded at a reduced scale, so the others are checked before anything loads them
+                raise core.OriginalTooLargeError
+
+            if is_jpeg:
+                # the EXIF of a JPEG is read with its header, getexif() doesn't load the pixels
+                width, height = img.size
+                if img.getexif().get(ORIENTATION_TAG) in (5, 6, 7, 8):
+                    width, height = height, width
+                size, crop, background, canvas = plan(width, height, cmd, options)
+                if settings.DECODE_SIZE_HINT_FACTOR:
+                    draft_size = math.ceil(max(size) * settings.DECODE_SIZE_HINT_FACTOR)
+                    img.draft(None, (draft_size, draft_size))
+                if settings.MAX_ORIGINAL_PIXELS and img.width * img.height > settings.MAX_ORIGINAL_PIXELS:
+                    raise core.OriginalTooLargeError
+            try:
+                img = ImageOps.exif_transpose(img)
+            except Image.DecompressionBombError:
+                raise core.OriginalTooLargeError
+            except OSError:
+                raise core.InvalidImageError
+            if not is_jpeg:
+                size, crop, background, canvas = plan(img.width, img.height, cmd, options)
+            icc_profile = img.info.get('icc_profile')
+            has_alpha = img.mode in ('LA', 'RGBA') or (img.mode == 'P' and 'transparency' in img.info)
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+
+        with metrics.timer('op_' + cmd):
+            factor = min(img.width // size[0], img.height // size[1]) // 2
+            if factor >= 2:
+                img = img.reduce(factor)
+            img = img.resize(size, Image.LANCZOS)
+            if crop:
+                img = img.crop(crop)
+            color = make_color(options['frame_bg_color'], options['opacity'])
+            if background:
+                img = set_background(img, color)
+            if canvas:
+                img = fit_frame(img, canvas, color)
+
+        with metrics.timer('encode'):
+            fmt = self.output_formats[options['out_format']]
+            if fmt == 'JPEG':
+                img = img.convert('RGB')
+            save = partial(encode, img, fmt, icc_profile)
+            if core.is_auto_quality(options):
+                data = core.encode_auto_quality(save, numpy.asarray(img.convert('RGBA')))
+            else:
+                data = save(core.get_quality(options))
+        return BytesIO(data)
+
+
+class AnimatedGifBackend(object):
+    """
+    Renders animated GIFs to animated WebP with Pillow.
+
+    Frames are decoded one at a time, already composited over the previous frames, and resized
+    before the next one is decoded, so only the resized animation is kept in memory. The WebP
+    encoder then stores each frame as the rectangle that changed from the previous one.
+    """
+    name = 'gif'
+    commands = PillowBackend.commands
+
+    def supports(self, cmd, options):
+        return (cmd in self.commands
+                and options['out_format'] == 'webp'
+                and not options.get('filters')
+                and not options.get('premultiplied_alpha')
+                and options.get('gravity') != 'smart'
+                and not any(options.get(k) for k in ('crop_x', 'crop_y', 'crop_width', 'crop_height')))
+
+    def render(self, data, cmd, options, size_hint=None) -> BytesIO:
+        try:
+            img = Image.open(BytesIO(data))
+        except (UnidentifiedImageError, Image.DecompressionBombError):
+            raise UnsupportedImageError('not a gif')
+        if img.format != 'GIF':
+            raise UnsupportedImageError(img.format)
+        with metrics.timer('probe'):
+            frame_count = getattr(img, 'n_frames', 1)
+        if (settings.GIF_MAX_FRAMES and frame_count > settings.GIF_MAX_FRAMES
+                or settings.GIF_MAX_PIXELS and frame_count * img.width * img.height > settings.GIF_MAX_PIXELS):
+            raise core.OriginalTooLargeError
+
+        size, crop, background, canvas = plan(img.width, img.height, cmd, options)
+        color = make_color(options['frame_bg_color'], options['opacity'])
+        frames = []
+        durations = []
+        with metrics.timer('op_' + cmd):
+            try:
+                for frame in ImageSequence.Iterator(img):
+                    # like browsers, play very short frames at 10 frames per second
+                    duration = frame.info.get('duration') or 0
+                    durations.append(duration if duration >= 20 else 100)
+                    frame = frame.convert('RGBA').resize(size, Image.LANCZOS)
+                    if crop:
+                        frame = frame.crop(crop)
+                    if background:
+                        frame = set_background(frame, color)
+                    if canvas:
+                        frame = fit_frame(frame, canvas, color)
+                    frames.append(frame)
+            except OSError:
+                raise core.InvalidImageError
+
+        f = BytesIO()
+        with metrics.timer('encode'):
+            # GIFs without a loop count play once, a WebP loop count of 0 loops forever
+            frames[0].save(f, 'WEBP', save_all=True, append_images=frames[1:], duration=durations,
+                           loop=img.info.get('loop', 1), quality=core.get_quality(options))
+        f.seek(0)
+        return f
+
+
+def encode(img, fmt, icc_profile, quality) -> bytes:
+    f = BytesIO()
+    if fmt == 'JPEG':
+        # like ImageMagick, don't subsample chroma at high qualities
+        img.save(f, fmt, quality=quality, subsampling=0 if quality >= 90 else 2, icc_profile=icc_profile)
+    else:
+        img.save(f, fmt, quality=quality, icc_profile=icc_profile)
+    return f.getvalue()
+
+
+def plan(width, height, cmd, options):
+    """
+    Plans a render like ImageOperator.resize. Returns the size to resize an oriented image of the
+    given size to, the box to crop the resized image to (or None), whether to blend it over the
+    background color and the size of the canvas to center it on (or None).
+    """
+    wanted_width = options['w']
+    wanted_height = options['h']
+    crop = None
+    background = False
+    canvas = None
+    if wanted_width and wanted_height:
+        if cmd == 'resize_then_crop':
+            # cover the wanted size, then crop
+            new_height = wanted_width * height / float(width)
+            if new_height >= wanted_height:
+                size = (wanted_width, int(round(new_height)))
+            else:
+                size = (int(round(wanted_height * width / float(height))), wanted_height)
+            x_offset = 0
+            y_offset = 0
+            if options.get('gravity') == 'center':
+                x_offset = max(0, int((size[0] - wanted_width) / 2))
+                y_offset = max(0, int((size[1] - wanted_height) / 2))
+            crop = (x_offset, y_offset,
+                    x_offset + min(wanted_width, size[0]), y_offset + min(wanted_height, size[1]))
+        elif options['preserve_ratio']:
+            scale = min(wanted_width / float(width), wanted_height / float(height))
+            size = (int(round(width * scale)), int(round(height * scale)))
+            background = True
+        else:
+            # ImageOperator.resize uses the width for both dimensions
+            size = (wanted_width, wanted_width)
+        if cmd == 'resize_then_fit':
+            canvas = (wanted_width, wanted_height)
+    elif wanted_width:
+        size = (wanted_width, int(round(wanted_width * height / float(width))))
+    else:
+        size = (int(round(wanted_height * width / float(height))), wanted_height)
+    return (max(1, size[0]), max(1, size[1])), crop, background, canvas
+
+
+def make_color(color_string, opacity=100):
+    """
+    Returns an RGBA tuple for a hex color string. Like ImageOperator.make_color, an opacity of 100
+    gives a fully transparent color.
+    """
+    cs = color_string.replace('#', '')
+    if len(cs) == 3:
+        cs = ''.join(c * 2 for c in cs)
+    return (int(cs[0:2], 16), int(cs[2:4], 16), int(cs[4:6], 16), int(round(255 * (1 - opacity / 100.0))))
+
+
+def set_background(img, color):
+    """
+    Blends the image over the background color, see ImageOperator.set_background.
+    """
+    if color[3] == 0 or img.mode != 'RGBA':
+        return img
+    img = Image.alpha_composite(Image.new('RGBA', img.size, color), img)
+    return img.convert('RGB') if color[3] == 255 else img
+
+
+def fit_frame(img, size, color):
+    """
+    Centers the image on a canvas of the given size filled with the color.
+    """
+    position = (int((size[0] - img.width) / 2), int((size[1] - img.height) / 2))
+    if color[3] == 255 and img.mode == 'RGB':
+        canvas = Image.new('RGB', size, color[:3])
+        canvas.paste(img, position)
+    else:
+        canvas = Image.new('RGBA', size, color)
+        canvas.alpha_composite(img.convert('RGBA'), position)
+    return canvas
+
+
+imagemagick = ImageMagickBackend()
+animated_gif = AnimatedGifBackend()
+backends = {
+    imagemagick.name: imagemagick,
+    PillowBackend.name: PillowBackend(),
+}
+
+
+def render(data, cmd, options, size_hint=None, backend=None):
+    """
+    Renders the derivative with the named backend (RENDER_BACKEND by default), falling back to
+    ImageMagick for requests and originals the backend doesn't support.
+    With RESIZE_GIFS, GIFs are rendered to animated WebP by the gif backend, and requests for them it
+    doesn't support are refused rather than decoding every frame with ImageMagick.
+    Returns a BytesIO and the name of the backend that rendered it.
+    """
+    name = backend or settings.RENDER_BACKEND
+    selected = backends.get(name)
+    if selected is None:
+        logger.warning("Unknown render backend %s, using ImageMagick", name)
+        selected = imagemagick
+    if settings.RESIZE_GIFS and data[:6] in (b'GIF87a', b'GIF89a') and options['out_format'] == 'webp':
+        if not animated_gif.supports(cmd, options):
+            raise UnsupportedGifOptionsError
+        selected = animated_gif
+    if selected is not imagemagick and selected.supports(cmd, options):
+        metrics.set_labels(backend=selected.name)
+        try:
+            return selected.render(data, cmd, options, size_hint=size_hint), selected.name
+        except UnsupportedImageError as e:
+            logger.debug("%s can't render the original (%s), using ImageMagick", selected.name, e)
+    metrics.set_labels(backend=imagemagick.name)
+    return imagemagick.render(data, cmd, options, size_hint=size_hint), imagemagick.name
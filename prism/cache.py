@@ -0,0 +1,232 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ExistenceCache(object):
+    """
+    A bounded, thread safe LRU cache of S3 object existence keyed by url.
+
+    Objects known to exist are remembered for `ttl` seconds and objects known to be missing
+    for `negative_ttl` seconds. A `max_size` of 0 disables the cache.
+    """
+
+    def __init__(self, max_size=10000, ttl=300, negative_ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """
+        Returns True or False if the existence of the object is known, otherwise None.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                exists, expires = entry
+                if expires > now:
+                    self._entries.move_to_end(url)
+                    self.hits += 1
+                    return exists
+                del self._entries[url]
+            self.misses += 1
+        return None
+
+    def set(self, url, exists):
+        if not self.max_size:
+            return
+        ttl = self.ttl if exists else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[url] = (exists, time.monotonic() + ttl)
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, url):
+        with self._lock:
+            self._entries.pop(url, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache(object):
+    """
+    A size bounded, LRU evicted cache of bytes on the local disk, safe to share between processes.
+
+    Each entry is stored in a single file holding a line of JSON metadata followed by the data.
+    Files are written to a temporary name and renamed into place, so readers always see a
+    complete entry. Hits update the modification time, which is used for LRU eviction.
+    """
+
+    def __init__(self, directory, max_bytes, scan_interval=100):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.scan_interval = scan_interval
+        self.hits = 0
+        self.misses = 0
+        self._estimated_bytes = None
+        self._puts = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name[:2], name)
+
+    def get(self, key):
+        """
+        Returns a (metadata, data) tuple for the key or None if it is not cached.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                metadata = json.loads(f.readline())
+                data = f.read()
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        self.touch(key)
+        return metadata, data
+
+    def touch(self, key):
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+
+    def discard(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def put(self, key, data, metadata=None):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(metadata or {}).encode('utf-8') + b'\n')
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception("Failed to write %s to the disk cache", key)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self._puts += 1
+            if self._estimated_bytes is not None:
+                self._estimated_bytes += len(data)
+            scan = (self._estimated_bytes is None or self._estimated_bytes > self.max_bytes
+                    or self._puts % self.scan_interval == 0)
+        if scan:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is within 90% of its budget.
+        Other processes may be writing to the same directory, so the sizes are always read from disk.
+        """
+        entries = []
+        total = 0
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.startswith('.tmp-') and stat.st_mtime > time.time() - 300:
+                    # being written by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total > self.max_bytes:
+            entries.sort()
+            target = self.max_bytes * 0.9
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+        with self._lock:
+            self._estimated_bytes = total
+
+
+class FrequencySketch(object):
+    """
+    Approximate counts of the recent requests for keys, for TinyLFU style cache admission.
+
+    A count-min sketch of `depth` rows of `width` saturating 8 bit counters. All counters are
+    halved every `sample_size` requests, so the counts follow the recent popularity of keys.
+    """
+
+    HALVE = bytes(i >> 1 for i in range(256))
+
+    def __init__(self, width=16384, depth=4, sample_size=None):
+        self.width = width
+        self.depth = depth
+        self.sample_size = sample_size or 10 * width
+        self._rows = [bytearray(width) for _ in range(depth)]
+        self._requests = 0
+        self._lock = threading.Lock()
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=4 * self.depth).digest()
+        return [int.from_bytes(digest[4 * i:4 * i + 4], 'little') % self.width for i in range(self.depth)]
+
+    def increment(self, key):
+        """
+        Counts a request for the key and returns its estimated count.
+        """
+        indexes = self._indexes(key)
+        with self._lock:
+            count = min(row[i] for row, i in zip(self._rows, indexes))
+            if count < 255:
+                # conservative update, only the smallest counters are incremented
+                for row, i in zip(self._rows, indexes):
+                    if row[i] == count:
+                        row[i] += 1
+                count += 1
+            self._requests += 1
+            if self._requests >= self.sample_size:
+                for row in self._rows:
+                    row[:] = row.translate(self.HALVE)
+                self._requests //= 2
+        return count
+
+    def frequency(self, key):
+        indexes = self._indexes(key)
+        with self._lock:
+            return min(row[i] for row, i in zip(self._rows, indexes))
@@ -1,39 +1,109 @@
+import hashlib
+import json
 import logging
 import os
+import threading
 import typing
 from dataclasses import dataclass, field
 from functools import partial
 import urllib.parse
 import boto
+import boto.s3.bucket
 import boto.s3.connection
 import requests
 from urllib3.util import Retry
 from requests.adapters import HTTPAdapter
 from io import BytesIO
 from boto.s3.key import Key
+from PIL import ExifTags
+from PIL import Image as PILImage
+from PIL.TiffImagePlugin import IFDRational
 from wand.image import Image
+from wand.resource import limits as resource_limits
 
-from prism.image import ImageOperator, convert_to_premultiplied_png
+import prism.metrics as metrics
+import prism.settings as settings
+from prism.cache import DiskCache, ExistenceCache, FrequencySketch
+from prism.image import ImageOperator, export_rgba_pixels
+from prism.quality import search_quality
 
 
 logger = logging.getLogger(__name__)
 
 
+# ImageMagick resource limits of this worker, see https://imagemagick.org/script/resources.php
+for resource, limit in settings.MAGICK_RESOURCE_LIMITS.items():
+    if limit:
+        resource_limits[resource] = limit
+
 # retry configuration for use with Requests to retry
 # connection, timeout and status 500 responses.
-retries = Retry(total=5,
-                backoff_factor=0.1,
+retries = Retry(total=settings.HTTP_MAX_RETRIES,
+                backoff_factor=settings.HTTP_RETRY_BACKOFF,
                 status_forcelist=[500])
 
+# One keep-alive session per (process, scheme, host), shared by all threads of a worker.
+# The process id is part of the key so sessions are never shared across a uwsgi fork.
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+# Rendered derivatives known to be present in (or missing from) the write buckets of this worker.
+result_exists_cache = ExistenceCache(max_size=settings.RESULT_CACHE_SIZE,
+                                     ttl=settings.RESULT_CACHE_TTL,
+                                     negative_ttl=settings.RESULT_CACHE_NEGATIVE_TTL)
+
+# Originals downloaded by any worker on this host, revalidated with conditional GETs.
+originals_cache = None
+if settings.ORIGINALS_CACHE_DIR:
+    originals_cache = DiskCache(settings.ORIGINALS_CACHE_DIR, max_bytes=settings.ORIGINALS_CACHE_SIZE)
+
+# Bytes of hot derivatives shared by the workers on this host, admitted by their recent requests in this worker.
+hot_cache = None
+hot_requests = None
+if settings.HOT_CACHE_DIR:
+    hot_cache = DiskCache(settings.HOT_CACHE_DIR, max_bytes=settings.HOT_CACHE_SIZE)
+    hot_requests = FrequencySketch()
+
+metrics.register_gauge('prism_result_cache_hits', 'Hits of the rendered image existence cache.',
+                       lambda: result_exists_cache.hits)
+metrics.register_gauge('prism_result_cache_misses', 'Misses of the rendered image existence cache.',
+                       lambda: result_exists_cache.misses)
+metrics.register_gauge('prism_result_cache_size', 'Entries in the rendered image existence cache.',
+                       lambda: len(result_exists_cache))
+if originals_cache:
+    metrics.register_gauge('prism_originals_cache_hits', 'Hits of the originals disk cache.',
+                           lambda: originals_cache.hits)
+    metrics.register_gauge('prism_originals_cache_misses', 'Misses of the originals disk cache.',
+                           lambda: originals_cache.misses)
+if hot_cache:
+    metrics.register_gauge('prism_hot_cache_hits', 'Hits of the hot derivatives cache.',
+                           lambda: hot_cache.hits)
+    metrics.register_gauge('prism_hot_cache_misses', 'Misses of the hot derivatives cache.',
+                           lambda: hot_cache.misses)
+
 
 class EmptyOriginalFile(Exception):
     message = 'The original file has 0 bytes.'
 
 
+class UnsupportedHeaderError(Exception):
+    """
+    Raised by header_info for images whose info can't be read from their header.
+    """
+
+
 class InvalidImageError(Exception):
     message = 'InvalidImageError. Image file is corrupted or invalid.'
 
 
+class OriginalTooLargeError(Exception):
+    message = 'The original image has too many pixels.'
+
+
+class OriginalFileTooLargeError(OriginalTooLargeError):
+    message = 'The original image file is too large.'
+
+
 def info(img):
     img.auto_orient()  # orient the image properly using exif info
     data = {'img_type': img.type,
@@ -50,39 +120,253 @@ def info(img):
     return data
 
 
+# Formats whose info is read from the header, in PIL naming, and the ImageMagick types of their modes
+HEADER_INFO_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+HEADER_INFO_TYPES = {
+    '1': 'bilevel',
+    'L': 'grayscale',
+    'LA': 'grayscalealpha',
+    'P': 'palette',
+    'RGB': 'truecolor',
+    'RGBA': 'truecoloralpha',
+    'CMYK': 'colorseparation',
+}
+# Metadata of rendered images, S3 allows 2KB of user metadata per object
+RESULT_INFO_METADATA = 'prism-info'
+RESULT_INFO_MAX_METADATA_BYTES = 1800
+RESULT_INFO_SIDECAR_SUFFIX = '.info.json'
+
+# PIL tag names that differ from the ImageMagick exif property names
+EXIF_TAG_ALIASES = {'ExifImageWidth': 'PixelXDimension', 'ExifImageHeight': 'PixelYDimension'}
+
+
+def _format_exif_value(value):
+    if isinstance(value, bytes):
+        return None
+    if isinstance(value, tuple):
+        return ', '.join(_format_exif_value(v) or '' for v in value)
+    if isinstance(value, IFDRational):
+        return '%s/%s' % (value.numerator, value.denominator)
+    return str(value).rstrip('\x00')
+
+
+def sniff_format(data: bytes) -> typing.Optional[str]:
+    """
+    Returns the format of the image in data from its signature, in PIL naming, if it is one of
+    HEADER_INFO_FORMATS.
+    """
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'GIF'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def header_info(data: bytes) -> typing.Optional[dict]:
+    """
+    Reads the same info as info() from the start of an image file, without decoding the pixels.
+    Returns None if the headers aren't complete and raises UnsupportedHeaderError for other formats.
+    """
+    if sniff_format(data) is None:
+        raise UnsupportedHeaderError
+    try:
+        img = PILImage.open(BytesIO(data))
+        if img.format not in HEADER_INFO_FORMATS or img.mode not in HEADER_INFO_TYPES:
+            raise UnsupportedHeaderError
+        # getexif() would load the pixels of formats that can store their EXIF after them
+        exif = PILImage.Exif()
+        if img.info.get('exif'):
+            exif.load(img.info['exif'])
+    except UnsupportedHeaderError:
+        raise
+    except Exception:
+        return None
+    width, height = img.size
+    if exif.get(ExifTags.Base.Orientation) in (5, 6, 7, 8):
+        width, height = height, width
+    alpha_channel = img.mode in ('LA', 'RGBA') or 'transparency' in img.info
+    img_type = HEADER_INFO_TYPES[img.mode]
+    if alpha_channel and not img_type.endswith('alpha'):
+        img_type += 'alpha'
+    tags = [(ExifTags.TAGS.get(k), v) for k, v in exif.items()]
+    tags += [(ExifTags.TAGS.get(k), v) for k, v in exif.get_ifd(ExifTags.IFD.Exif).items()]
+    tags += [(ExifTags.GPSTAGS.get(k), v) for k, v in exif.get_ifd(ExifTags.IFD.GPSInfo).items()]
+    result = {'img_type': img_type,
+              'alpha_channel': alpha_channel,
+              'exif': {},
+              'width': width,
+              'height': height
+              }
+    for name, value in tags:
+        value = _format_exif_value(value)
+        if name and value is not None and not name.endswith(('IFD', 'Offset')):
+            result['exif']['exif:%s' % EXIF_TAG_ALIASES.get(name, name)] = value
+    return result
+
+
+def fetch_info(url) -> dict:
+    """
+    Returns the info of the original image, reading it from the first INFO_RANGE_BYTES of the file
+    with a ranged GET. The range is grown up to INFO_RANGE_MAX_BYTES if the headers are longer.
+    Formats header_info can't read are downloaded and decoded in full.
+    """
+    size = settings.INFO_RANGE_BYTES
+    while size and size <= settings.INFO_RANGE_MAX_BYTES:
+        s = get_http_session(url)
+        with metrics.timer('get'):
+            r = s.get(url, timeout=5.0, headers={'Range': 'bytes=0-%i' % (size - 1)})
+        if r.status_code == 416:
+            # the range isn't satisfiable for an empty file
+            raise EmptyOriginalFile
+        r.raise_for_status()
+        data = r.content
+        complete = r.status_code == 200 or len(data) < size
+        try:
+            with metrics.timer('probe'):
+                result = header_info(data)
+        except UnsupportedHeaderError:
+            # a larger range won't help
+            return info(decode_image(data) if complete else fetch_image(url))
+        if result is not None:
+            return result
+        if complete:
+            return info(decode_image(data))
+        size *= 4
+    return info(fetch_image(url))
+
+
 def resize(img, cmd, options):
-    imop = ImageOperator(img)
+    with metrics.timer('orient'):
+        imop = ImageOperator(img)
     width = options['w']
     height = options['h']
 
     fn = getattr(imop, cmd)
     # calling our resize function now, yeahh !!!
     logging.info("resizing %s w: %s, h: %s, options: %s", fn, width, height, options)
-    fn((width, height), **options)
+    with metrics.timer('op_' + cmd):
+        fn((width, height), **options)
 
     filters = options.get('filters')
     if filters:
-        for filter in filters:
-            logging.info("adding filter %s", filter)
-            fn_filter = getattr(imop, filter['id'])
+        with metrics.timer('op_filters'):
+            imop.apply_filters(filters)
 
-            t = {}
-            for k, v in filter.iteritems():
-                t[k.replace('-', '_')] = v
-            fn_filter(**t)
-
-    imop.image.compression_quality = options['q']
     f = BytesIO()
-    imop.write(f, options['out_format'])
-    f.seek(0)
-
     if options['premultiplied_alpha']:
-        f = convert_to_premultiplied_png(f)
-        f.seek(0)
+        with metrics.timer('premultiply'):
+            imop.write_premultiplied_png(f)
+    elif is_auto_quality(options):
+        with metrics.timer('encode'):
+            f.write(encode_auto_quality(partial(encode, imop, options['out_format']),
+                                        export_rgba_pixels(imop.image.clone())))
+    else:
+        imop.image.compression_quality = get_quality(options)
+        with metrics.timer('encode'):
+            imop.write(f, options['out_format'])
+    f.seek(0)
     return f
 
 
-def get_thumb_filename(file_name, cmd, options):
+def encode(imop, fmt, quality) -> bytes:
+    imop.image.compression_quality = quality
+    f = BytesIO()
+    imop.write(f, fmt)
+    return f.getvalue()
+
+
+def encode_auto_quality(encode, reference) -> bytes:
+    """
+    Encodes at the lowest quality meeting AUTO_QUALITY_TARGET, see search_quality, and records the quality.
+    """
+    quality, data = search_quality(encode, reference,
+                                   target=settings.AUTO_QUALITY_TARGET,
+                                   min_quality=settings.AUTO_QUALITY_MIN,
+                                   max_quality=settings.AUTO_QUALITY_MAX,
+                                   time_budget=settings.AUTO_QUALITY_TIME_BUDGET)
+    logger.debug("auto quality %s", quality)
+    metrics.observe_quality(quality)
+    return data
+
+
+def is_auto_quality(options):
+    """
+    Returns whether the quality of the output should be searched for with search_quality.
+    This only applies to lossy formats.
+    """
+    return options['q'] == 'auto' and options['out_format'] in ('jpg', 'jpeg', 'webp')
+
+
+def get_quality(options):
+    """
+    Returns the fixed quality to encode with, AUTO_QUALITY_MAX for q=auto in lossless formats.
+    """
+    return settings.AUTO_QUALITY_MAX if options['q'] == 'auto' else options['q']
+
+
+def _canonical_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _canonical_color(value):
+    color = str(value).replace('#', '').upper()
+    if len(color) == 6 and color[0::2] == color[1::2]:
+        # FFCC00 is the same color as FC0
+        color = color[0::2]
+    return color
+
+
+def canonicalize_options(cmd, options):
+    """
+    Returns a copy of the options normalised so that requests which render the same image have the same options.
+
+    Values are converted to their canonical type and case, and options which have no effect on the
+    output of the command are reset to their defaults so they are left out of the filename.
+    This must be kept in sync with what ImageOperator.resize actually uses.
+    """
+    canonical = dict(options)
+    both_dimensions = bool(options['w'] and options['h'])
+    crop_keys = ('crop_x', 'crop_y', 'crop_width', 'crop_height')
+    has_crop = both_dimensions and cmd not in ('resize_then_crop', 'smart_crop') and all(options.get(k) for k in crop_keys)
+    for k in crop_keys:
+        canonical[k] = _canonical_int(options.get(k)) if has_crop else None
+
+    preserve_ratio_used = cmd in ('resize', 'resize_then_fit') and both_dimensions and not has_crop
+    canonical['preserve_ratio'] = bool(options['preserve_ratio']) if preserve_ratio_used else True
+
+    background_used = cmd == 'resize_then_fit' or (preserve_ratio_used and canonical['preserve_ratio'])
+    canonical['frame_bg_color'] = _canonical_color(options['frame_bg_color']) if background_used else 'FFF'
+
+    if cmd != 'resize_then_crop':
+        canonical['gravity'] = 'center'
+    canonical['q'] = _canonical_int(options['q'])
+    # any non empty value enables premultiplied alpha
+    canonical['premultiplied_alpha'] = '1' if options['premultiplied_alpha'] else None
+    if options['filters']:
+        canonical['filters'] = json.dumps(options['filters'], sort_keys=True, separators=(',', ':'))
+    else:
+        canonical['filters'] = None
+    return canonical
+
+
+def get_thumb_filename(file_name, cmd, options, key_format=None):
+    """
+    Returns the key of the derivative in the write bucket.
+
+    key_format is one of
+    'legacy': params are formatted from the raw option values,
+    'canonical': params are formatted from canonicalize_options, which gives the same keys as 'legacy' for
+                 requests which are already canonical,
+    'hashed': like 'canonical' but the params are replaced by a short hash to keep keys short.
+    It defaults to settings.DERIVATIVE_KEY_FORMAT.
+    """
     # Note: The filenames produced by this function do not match those of previous versions of Prism.
     # We cannot match the format of the previous version in Python 3.
     # This causes s3 misses against all previously generated images. We are ok with that.
@@ -106,12 +390,18 @@ def get_thumb_filename(file_name, cmd, options):
         'filters': None,
     }
 
+    key_format = key_format or settings.DERIVATIVE_KEY_FORMAT
+    if key_format != 'legacy':
+        options = canonicalize_options(cmd, options)
+
     params = []
     for k in default_options:
         if options[k] != default_options.get(k) and options[k] is not None:
             value = options[k]
             params.append(f'{k}__{value}')
     param_string = '--'.join(params)
+    if key_format == 'hashed' and param_string:
+        param_string = hashlib.sha1(param_string.encode('utf-8')).hexdigest()[:16]
 
     out_format = options['out_format']
     if out_format == "":
@@ -138,9 +428,12 @@ def split_endpoint_url(endpoint_url: str) -> typing.Tuple[str, int, bool]:
     return host, port, secure
 
 
-@dataclass
+@dataclass(frozen=True)
 class S3ConnectionConfig:
-    """Config for connecting to S3 with fallback to environment variables."""
+    """Config for connecting to S3 with fallback to environment variables.
+
+    Instances are immutable and hashable so they can be used as cache keys.
+    """
     key_id: typing.Optional[str] = field(default_factory=partial(os.environ.get, 'AWS_ACCESS_KEY_ID'))
     secret_key: typing.Optional[str] = field(default_factory=partial(os.environ.get, 'AWS_SECRET_ACCESS_KEY'))
     region: typing.Optional[str] = field(default_factory=partial(os.environ.get, 'AWS_REGION'))
@@ -179,6 +472,48 @@ def get_s3_client(config: typing.Optional[S3ConnectionConfig] = None) -> boto.s3
     return conn
 
 
+# boto connections are not safe to share between threads, so connections and bucket handles
+# are cached per thread. Bumping the generation invalidates the caches of all threads.
+_s3_clients = threading.local()
+_s3_clients_generation = 0
+
+
+def _get_s3_client_cache() -> dict:
+    if getattr(_s3_clients, 'generation', None) != _s3_clients_generation:
+        _s3_clients.generation = _s3_clients_generation
+        _s3_clients.connections = {}
+        _s3_clients.buckets = {}
+    return _s3_clients.__dict__
+
+
+def get_cached_s3_client(config: S3ConnectionConfig) -> boto.s3.connection.S3Connection:
+    """ Get an S3 connection for the given configuration, reusing one from a previous request if possible.
+    """
+    connections = _get_s3_client_cache()['connections']
+    conn = connections.get(config)
+    if conn is None:
+        conn = connections[config] = get_s3_client(config)
+    return conn
+
+
+def get_cached_bucket(bucket_name: str, config: S3ConnectionConfig) -> boto.s3.bucket.Bucket:
+    """ Get a bucket handle, validating that the bucket exists only the first time it is used.
+    """
+    buckets = _get_s3_client_cache()['buckets']
+    key = (config, bucket_name)
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = get_cached_s3_client(config).get_bucket(bucket_name)
+    return bucket
+
+
+def clear_s3_client_cache():
+    """ Drop all cached S3 connections and bucket handles, e.g. after credentials are rotated.
+    """
+    global _s3_clients_generation
+    _s3_clients_generation += 1
+
+
 def get_s3_url(bucket_name, bucket_region, path, endpoint=None):
     """Get the public URL for an S3 object.
 
@@ -206,54 +541,280 @@ def get_s3_url(bucket_name, bucket_region, path, endpoint=None):
     return url
 
 
-def fetch_image(url):
-    s = requests.Session()
-    s.mount('https://', HTTPAdapter(max_retries=retries))
-    print(f"Fetching {url}")
-    r = s.get(url, timeout=5.0)
-    t = r.elapsed.total_seconds()
-    logging.info('S3 GET request time: %0.2f', t)
-    r.raise_for_status()
-    if r.headers['content-length'] == '0':
-        raise EmptyOriginalFile
+def get_http_session(url: str) -> requests.Session:
+    """ Get the pooled requests Session for the host of the given url.
+
+    Connections are kept alive and reused between requests, so only the first request
+    to a host from a worker pays for the TCP and TLS handshakes.
+    """
+    parsed_url = urllib.parse.urlparse(url)
+    key = (os.getpid(), parsed_url.scheme, parsed_url.netloc)
+    session = _http_sessions.get(key)
+    if session is None:
+        with _http_sessions_lock:
+            session = _http_sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=settings.HTTP_POOL_SIZE,
+                                      max_retries=retries)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                if not settings.HTTP_KEEP_ALIVE:
+                    session.headers['Connection'] = 'close'
+                _http_sessions[key] = session
+    return session
+
+
+def download_original(url) -> typing.Tuple[bytes, typing.Optional[str]]:
+    """
+    Downloads the original image. Returns its bytes and its ETag, if S3 sent one.
+
+    If the originals cache is enabled, a cached copy is revalidated with a conditional GET
+    and only downloaded again if it has changed.
+    """
+    s = get_http_session(url)
+    headers = {}
+    cached = originals_cache.get(url) if originals_cache else None
+    if cached:
+        metadata, data = cached
+        if metadata.get('etag'):
+            headers['If-None-Match'] = metadata['etag']
+        if metadata.get('last_modified'):
+            headers['If-Modified-Since'] = metadata['last_modified']
+    logger.debug("Fetching %s", url)
+    with metrics.timer('get'):
+        with s.get(url, timeout=5.0, headers=headers, stream=True) as r:
+            t = r.elapsed.total_seconds()
+            logging.info('S3 GET request time: %0.2f', t)
+            if cached and r.status_code == 304:
+                return data, metadata.get('etag')
+            r.raise_for_status()
+            if r.headers['content-length'] == '0':
+                raise EmptyOriginalFile
+            content = read_body(r, settings.MAX_ORIGINAL_BYTES)
+    if originals_cache and (r.headers.get('etag') or r.headers.get('last-modified')):
+        originals_cache.put(url, content, {
+            'etag': r.headers.get('etag'),
+            'last_modified': r.headers.get('last-modified'),
+        })
+    return content, r.headers.get('etag')
+
+
+def download_result(url, max_bytes=0) -> typing.Optional[bytes]:
+    """
+    Downloads a rendered derivative. Returns None without reading the body if it is larger than max_bytes.
+    """
+    s = get_http_session(url)
+    with metrics.timer('get_result'):
+        with s.get(url, timeout=5.0, stream=True) as r:
+            r.raise_for_status()
+            if max_bytes and int(r.headers.get('content-length') or 0) > max_bytes:
+                return None
+            return r.content
+
+
+def read_body(r: requests.Response, max_bytes=0) -> bytes:
+    """
+    Reads the body of a streamed response, refusing bodies larger than max_bytes (0 for no limit)
+    as soon as they are known to be too large, without downloading the rest.
+
+    A body with a known length and no content encoding is read in one go into a single bytes
+    object, so it isn't held twice while chunks are joined.
+    """
+    content_length = int(r.headers.get('content-length') or 0)
+    if max_bytes and content_length > max_bytes:
+        raise OriginalFileTooLargeError
+    if content_length and not r.headers.get('content-encoding'):
+        return r.raw.read(decode_content=True)
+    chunks = []
+    size = 0
+    for chunk in r.iter_content(chunk_size=64 * 1024):
+        size += len(chunk)
+        if max_bytes and size > max_bytes:
+            raise OriginalFileTooLargeError
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def get_decode_size_hint(cmd, options) -> typing.Optional[typing.Tuple[int, int]]:
+    """
+    Returns the smallest size the original needs to be decoded at to render the derivative, or None if
+    the full resolution is needed.
+
+    The hint is DECODE_SIZE_HINT_FACTOR times the largest output dimension, so the final resize
+    still downscales from a larger image and the output is visually unchanged.
+    It is square because the orientation of the original is only known after decoding.
+    """
+    if not settings.DECODE_SIZE_HINT_FACTOR or cmd not in ('resize', 'resize_then_crop', 'resize_then_fit', 'smart_crop'):
+        return None
+    if options.get('crop_x') or options.get('crop_y') or options.get('crop_width') or options.get('crop_height'):
+        # crop coordinates are relative to the full resolution original
+        return None
+    if options.get('filters'):
+        # filters may use pixel coordinates too
+        return None
+    size = max(options['w'] or 0, options['h'] or 0)
+    if not size:
+        return None
+    size = int(size * settings.DECODE_SIZE_HINT_FACTOR)
+    return size, size
+
+
+def check_pixel_budget(data: bytes, size_hint: typing.Optional[typing.Tuple[int, int]] = None):
+    """
+    Reads only the header of the image and raises OriginalTooLargeError if decoding it would use more than
+    MAX_ORIGINAL_PIXELS pixels. JPEGs that will be decoded at a reduced scale are allowed if the reduced
+    size is within the budget.
+    """
     try:
-        im = Image(file=BytesIO(r.content))
+        with Image.ping(blob=data) as probe:
+            width, height, image_format = probe.width, probe.height, probe.format
+    except Exception:
+        raise InvalidImageError
+    pixels = width * height
+    if pixels > settings.MAX_ORIGINAL_PIXELS and image_format == 'JPEG' and size_hint:
+        # libjpeg decodes at the smallest of 1/1, 1/2, 1/4 and 1/8 scale that still covers the hint
+        scale = min(width / size_hint[0], height / size_hint[1])
+        denominator = max([d for d in (1, 2, 4, 8) if d <= scale] or [1])
+        pixels = pixels // (denominator * denominator)
+    if pixels > settings.MAX_ORIGINAL_PIXELS:
+        logger.warning("Rejecting original of %ix%i pixels", width, height)
+        raise OriginalTooLargeError
+
+
+def decode_image(data: bytes, size_hint: typing.Optional[typing.Tuple[int, int]] = None):
+    """
+    Decodes the original image.
+
+    If a size hint is given, JPEGs are decoded at the smallest 1/2, 1/4 or 1/8 scale at which
+    both dimensions are at least as large as the hint.
+    """
+    if settings.MAX_ORIGINAL_PIXELS:
+        with metrics.timer('probe'):
+            check_pixel_budget(data, size_hint)
+    try:
+        im = Image()
+        if size_hint:
+            im.options['jpeg:size'] = '%ix%i' % size_hint
+        with metrics.timer('decode'):
+            im.read(blob=data)
     except Exception:
         raise InvalidImageError
     return im
 
 
-def check_s3_object_exists(url):
-    s = requests.Session()
-    s.mount('https://', HTTPAdapter(max_retries=retries))
+def fetch_image(url, size_hint: typing.Optional[typing.Tuple[int, int]] = None):
+    """
+    Downloads and decodes the original image.
+    """
+    data, _ = download_original(url)
+    return decode_image(data, size_hint=size_hint)
+
+
+def check_s3_object_exists(url, cache: typing.Optional[ExistenceCache] = None):
+    """
+    Checks whether the object exists with a HEAD request.
+
+    If a cache is given, a known answer is returned from it without a request
+    and the answer of the request is stored in it.
+    """
+    if cache is not None:
+        exists = cache.get(url)
+        if exists is not None:
+            return exists
+    s = get_http_session(url)
     try:
-        r = s.head(url, timeout=1.0)
+        with metrics.timer('head'):
+            r = s.head(url, timeout=1.0)
         t = r.elapsed.total_seconds()
         logging.info('S3 HEAD request time: %0.2f', t)
         r.raise_for_status()
     except requests.HTTPError as e:
         if e.response.status_code in (404, 403):
-            return False
+            exists = False
         else:
             raise
-    return True
+    else:
+        exists = True
+    if cache is not None:
+        cache.set(url, exists)
+    return exists
 
 
-def upload_file(bucket_name: str, s3_config: S3ConnectionConfig, file: typing.BinaryIO, new_filename: str) -> str:
+def make_result_info(source_etag: typing.Optional[str], rendered: bytes, original_info: typing.Optional[dict]) -> dict:
     """
-    uploads file to s3 bucket under prism-images folder
+    Returns the metadata stored with a rendered image: its dimensions, size and format,
+    the ETag of the original it was rendered from and the info of the original.
     """
+    result = {'size': len(rendered),
+              'source_etag': source_etag.strip('"') if source_etag else None,
+              'original': original_info}
+    try:
+        img = PILImage.open(BytesIO(rendered))
+        result.update(width=img.width, height=img.height, format=img.format.lower())
+    except Exception:
+        pass
+    return result
 
-    conn = get_s3_client(s3_config)
 
-    bucket = conn.get_bucket(bucket_name)
+def get_result_info(url) -> typing.Optional[dict]:
+    """
+    Returns the metadata stored with the rendered image at the url by upload_file,
+    or None if the image doesn't exist or was uploaded without it.
+    """
+    s = get_http_session(url)
+    with metrics.timer('head'):
+        r = s.head(url, timeout=1.0)
+    if r.status_code in (404, 403):
+        return None
+    r.raise_for_status()
+    value = r.headers.get('x-amz-meta-%s' % RESULT_INFO_METADATA)
+    if not value:
+        return None
+    if value == 'sidecar':
+        with metrics.timer('get'):
+            r = s.get(url + RESULT_INFO_SIDECAR_SUFFIX, timeout=1.0)
+        if r.status_code in (404, 403):
+            return None
+        r.raise_for_status()
+        value = r.text
+    try:
+        return json.loads(value)
+    except ValueError:
+        logger.warning("Invalid result info for %s", url)
+        return None
+
+
+def upload_file(bucket_name: str, s3_config: S3ConnectionConfig, file: typing.BinaryIO, new_filename: str,
+                url: typing.Optional[str] = None, info: typing.Optional[dict] = None) -> str:
+    """
+    uploads file to s3 bucket under prism-images folder
+
+    If the public url of the object is given it is remembered in the result_exists_cache.
+    The info, if given, is stored as metadata of the object, or in a sidecar object
+    if it is too large for S3 metadata.
+    """
+
+    bucket = get_cached_bucket(bucket_name, s3_config)
 
     extension = new_filename.rsplit('.', 1)[-1].lower()
 
     k = Key(bucket)
     k.key = new_filename
     k.content_type = 'image/%s' % extension
-    k.set_contents_from_file(file, policy='public-read')
+    if info is not None:
+        value = json.dumps(info, separators=(',', ':'), sort_keys=True)
+        if len(value) > RESULT_INFO_MAX_METADATA_BYTES:
+            sidecar = Key(bucket)
+            sidecar.key = new_filename + RESULT_INFO_SIDECAR_SUFFIX
+            sidecar.content_type = 'application/json'
+            with metrics.timer('upload'):
+                sidecar.set_contents_from_string(value, policy='public-read')
+            value = 'sidecar'
+        k.set_metadata(RESULT_INFO_METADATA, value)
+    with metrics.timer('upload'):
+        k.set_contents_from_file(file, policy='public-read')
 
     s3_path = k.generate_url(expires_in=0, query_auth=False, force_http=True)
     if '?' in s3_path:
@@ -261,4 +822,6 @@ def upload_file(bucket_name: str, s3_config: S3ConnectionConfig, file: typing.Bi
         # we just upload public stuff
         s3_path = s3_path.split('?')[0]
 
+    if url:
+        result_exists_cache.set(url, True)
     return s3_path
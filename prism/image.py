@@ -1,12 +1,39 @@
-from io import BytesIO
-from wand.image import Image
+import ctypes
+import inspect
+import math
+import re
+from wand.api import library
+from wand.image import Image, STORAGE_TYPES
 from wand.color import Color
 from PIL import Image as Img
 import numpy
 import logging
 
+from prism.saliency import PROXY_SIZE, best_window, saliency
+
 logger = logging.getLogger(__name__)
 
+# Filters that can be given in the filters parameter
+FILTERS = ('translucent', 'unsharp_mask')
+# Colors of filter parameters (named *_color) as read by hex_to_int
+HEX_COLOR = re.compile(r'^#?([0-9a-fA-F]{3}|[0-9a-fA-F]{6})$')
+# Largest values of the numeric filter parameters, which can't be negative. The composite_* parameters
+# are pixels and have to be integers, the same bound as the requested dimensions.
+FILTER_PARAMETER_LIMITS = {
+    'opacity': 100,
+    'radius': 100,
+    'sigma': 100,
+    'amount': 10,
+    'threshold': 1,
+    'composite_width': 10000,
+    'composite_height': 10000,
+    'composite_x': 10000,
+    'composite_y': 10000,
+}
+# Gaussian blurs with a larger sigma run on a copy downscaled so the sigma becomes BLUR_PROXY_SIGMA
+BLUR_DOWNSAMPLE_MIN_SIGMA = 4.0
+BLUR_PROXY_SIGMA = 2.0
+
 
 class ImageOperator(object):
     def __init__(self, image):
@@ -43,7 +70,8 @@ class ImageOperator(object):
                            **options
                            )
 
-    def hex_to_int(self, color_string):
+    @staticmethod
+    def hex_to_int(color_string):
         """
         #FFFFFFF returns as (255, 255, 255)
         FFFFFF returns as (255, 255, 255)
@@ -65,6 +93,17 @@ class ImageOperator(object):
             int('%s' % cs[4:6], base=16),
         )
 
+    def make_color(self, color_string, opacity=100):
+        """
+        Returns the Color for a hex color string. An opacity of 100 gives a fully transparent color
+        and 0 an opaque one.
+        """
+        color_rgb = self.hex_to_int(color_string)
+        transp = 1 - opacity / 100.0
+        color_rgba_string = 'rgba(%s, %s, %s, %s)' % (color_rgb[0], color_rgb[1], color_rgb[2], transp)
+        logger.debug("color_rgba %s", color_rgba_string)
+        return Color(color_rgba_string)
+
     def fit_frame(self, background_color, width, height, opacity=100,
                   placement='center',
                   composite_x=0, composite_y=0, compression_quality=95):
@@ -72,43 +111,80 @@ class ImageOperator(object):
             composite_x = int((width - self.image.width) / 2)
             composite_y = int((height - self.image.height) / 2)
 
-        color_rgb = self.hex_to_int(background_color)
-        transp = 1 - opacity / 100.0
-        color_rgba_string = 'rgba(%s, %s, %s, %s)' % (color_rgb[0], color_rgb[1], color_rgb[2], transp)
-        print("color_rgba", color_rgba_string)
-        color = Color(color_rgba_string)
-        cover = Image(width=width, height=height, background=color)
+        color = self.make_color(background_color, opacity)
+        if color.alpha < 1 and not self.image.alpha_channel:
+            self.image.alpha_channel = 'set'
+        # extent composites the image over a canvas filled with the background color in a single step
+        self.image.background_color = color
+        self.image.extent(width=width, height=height, x=-composite_x, y=-composite_y)
+        self.image.compression_quality = compression_quality
+
+    def set_background(self, background_color, opacity=100):
+        """
+        Blends the image over the background color, like compositing it onto a canvas of the
+        background color, without allocating the canvas.
+        """
+        color = self.make_color(background_color, opacity)
+        if color.alpha == 0 or not self.image.alpha_channel:
+            # Over a transparent background, or with nothing transparent to blend, the visible pixels don't change
+            return
+        if color.alpha == 1:
+            self.image.background_color = color
+            self.image.alpha_channel = 'remove'
+            return
+        cover = Image(width=self.image.width, height=self.image.height, background=color)
         for k in self.image.profiles:
             value = self.image.profiles[k]
             if value is not None:
                 cover.profiles[k] = value
-        cover.composite(self.image, composite_x, composite_y)
+        cover.composite(self.image, 0, 0)
         self.image = cover
-        self.image.compression_quality = compression_quality
+
+    def apply_filters(self, filters):
+        """
+        Applies a list of filters validated by validate_filters, fused by plan_filters.
+        """
+        for filter_id, params in plan_filters(filters):
+            logger.debug("filter %s %s", filter_id, params)
+            getattr(self, filter_id)(**params)
 
     # this is a filter
     def translucent(self, background_color, opacity=20,
                     radius=10, sigma=10,
                     composite_width=None, composite_height=None,
                     composite_x=0, composite_y=0):
-
-        if not composite_width:
-            composite_width = self.image.width
-        if not composite_height:
-            composite_height = self.image.height
-
-        color_rgb = self.hex_to_int(background_color)
-        transp = 1 - opacity / 100.0
-        color_rgba_string = 'rgba(%s, %s, %s, %s)' % (color_rgb[0], color_rgb[1], color_rgb[2], transp)
-        color = Color(color_rgba_string)
-        cover = Image(width=composite_width,
-                      height=composite_height,
+        """
+        Blurs the image and covers it, or the given part of it, with the background color.
+        """
+        self.blur(radius, sigma)
+        color = self.make_color(background_color, opacity)
+        if not (composite_width or composite_height or composite_x or composite_y) and not self.image.alpha_channel:
+            # blend the color into the pixels, the same as covering them without allocating a cover
+            self.image.colorize(color=Color('rgb(%s, %s, %s)' % self.hex_to_int(background_color)),
+                                alpha=Color('rgb({0}%, {0}%, {0}%)'.format(color.alpha * 100)))
+            return
+        cover = Image(width=composite_width or self.image.width,
+                      height=composite_height or self.image.height,
                       background=color)
-        self.image.gaussian_blur(radius, sigma)
         self.image.composite(cover, composite_x, composite_y)
 
+    # this is a filter
     def unsharp_mask(self, radius=9, sigma=0.75, amount=0.75, threshold=0.008):
-        self.unsharp_mask(radius=radius, sigma=sigma, amount=amount, threshold=threshold)
+        self.image.unsharp_mask(radius=radius, sigma=sigma, amount=amount, threshold=threshold)
+
+    def blur(self, radius, sigma):
+        """
+        Gaussian blur. Large blurs are done on a downscaled copy which is scaled back up,
+        which looks the same and is many times faster.
+        """
+        width, height = self.image.size
+        factor = min(sigma / BLUR_PROXY_SIGMA, width / 16.0, height / 16.0)
+        if sigma < BLUR_DOWNSAMPLE_MIN_SIGMA or factor < 2:
+            self.image.gaussian_blur(radius, sigma)
+            return
+        self.image.resize(max(1, int(round(width / factor))), max(1, int(round(height / factor))), filter='box')
+        self.image.gaussian_blur(radius / factor, sigma / factor)
+        self.image.resize(width, height, filter='triangle')
 
     def resize(self, geometry,
                preserve_ratio=True,
@@ -139,211 +215,52 @@ class ImageOperator(object):
 
         :param preserve_ratio: we resize to given width and height without preserving ratio
 
-
+        The operations are planned up front by plan_resize from the dimensions of the image
+        and then applied once each. The image was already oriented in __init__.
         """
-        wanted_width = geometry[0]
-        wanted_height = geometry[1]
-        if wanted_width:
-            assert int(wanted_width) < 10000
-        if wanted_height:
-            assert int(wanted_height) < 10000
-
-        x_offset = 0
-        y_offset = 0
-
         gravity = 'top_left'
         if 'gravity' in options and options['gravity']:
             gravity = options['gravity']
 
-        assert gravity in ('center', 'top_left', 'smart')
-        use_smart_crop = gravity == 'smart'
-
-        try:
-            self.image.auto_orient()
-        except Exception:
-            pass
-
-        if wanted_width and wanted_height:
-
-            if resize_then_crop:
-                center_x, center_y = None, None
-                org_w, org_h = self.image.width, self.image.height
-                if use_smart_crop:
-                    raise NotImplementedError()
-
-                if self.height < wanted_height and self.width < wanted_width:
-                    # this is upscaling
-                    logging.info("we are upscaling")
-
-                    """
-                        590 x 393
-                        720
-                    """
-                    # calc from width
-                    next_height = wanted_width * (self.height / float(self.width))
-                    if next_height >= wanted_height:
-                        logging.debug("next height w:%s h:%s ", next_height, wanted_width)
-                        self.image.transform(resize="%sx" % wanted_width)
-                    else:
-                        logging.debug("next height -2- w:%s h:%s ", next_height, wanted_width)
-                        self.image.transform(resize="x%s" % wanted_height)
-
-                    # self.image.unsharp_mask(radius=10, sigma=4, amount=1.0, threshold=0)
+        operations = plan_resize(self.width, self.height, geometry,
+                                 preserve_ratio=preserve_ratio,
+                                 resize_then_crop=resize_then_crop,
+                                 resize_then_fit=resize_then_fit,
+                                 crop_x=crop_x, crop_y=crop_y, crop_width=crop_width, crop_height=crop_height,
+                                 frame_bg_color=frame_bg_color, opacity=opacity,
+                                 gravity=gravity)
+        self.apply(operations)
 
-                else:
-                    logger.info("we are downscaling")
-                    ratio = self.width / float(self.height)
-                    logger.debug("ratio: %0.2f", ratio)
-                    new_width = wanted_height * ratio
-                    new_height = wanted_width / ratio
-                    logger.debug("New width if scale by height: %s (%s wanted)", new_width, wanted_width)
-                    logger.debug("New height if scale by width: %s (%s wanted)", new_height, wanted_height)
-                    if new_height >= wanted_height:
-                        logger.debug("Scaling by width")
-                        thumbnail_width = wanted_width
-                        thumbnail_height = new_height
-                    else:
-                        logger.debug("Scaling by height")
-                        thumbnail_height = wanted_height
-                        thumbnail_width = new_width
-                    thumbnail_width = int(round(thumbnail_width))
-                    thumbnail_height = int(round(thumbnail_height))
-                    logger.debug('%ix%i', thumbnail_width, thumbnail_height)
-                    self.image.transform(resize="%ix%i" % (thumbnail_width, thumbnail_height))
-
-                thumbnail_width, thumbnail_height = self.image.size
-
-                logger.debug("thumbnail_width, thumbnail_height: %s, %s", thumbnail_width, thumbnail_height)
-
-                if thumbnail_width > wanted_width:
-                    if not center_x:
+    def apply(self, operations):
+        """
+        Applies a list of operations planned by plan_resize.
+        """
+        for operation, *args in operations:
+            logger.debug("%s %s", operation, args)
+            if operation == 'transform':
+                crop, resize = args
+                self.image.transform(crop=crop, resize=resize)
+            elif operation == 'crop':
+                # the offsets depend on the size the image was actually resized to
+                wanted_width, wanted_height, gravity = args
+                x_offset = 0
+                y_offset = 0
+                if gravity == 'smart':
+                    x_offset, y_offset = self.find_smart_crop(wanted_width, wanted_height)
+                elif gravity == 'center':
+                    thumbnail_width, thumbnail_height = self.image.size
+                    if thumbnail_width > wanted_width:
                         x_offset = int((thumbnail_width - wanted_width) / 2)
-                    else:
-                        # center_x = center_x * float(thumbnail_width / self.image.width)
-                        x_offset = center_x  # int(center_x - (wanted_width))
-
-                if thumbnail_height > wanted_height:
-                    if not center_y:
+                    if thumbnail_height > wanted_height:
                         y_offset = int((thumbnail_height - wanted_height) / 2)
-                    else:
-                        # center_y = center_y * float(thumbnail_height / self.image.height)
-                        y_offset = center_y  # int(center_y - (wanted_height))
-
-                logger.info("image size: %s", self.image.size)
-                logger.info("now we are cropping to %sx%s+%s+%s", wanted_width, wanted_height, x_offset, y_offset)
-
-                if gravity == 'center':
-                    self.image.transform(crop="%sx%s+%s+%s" % (wanted_width, wanted_height, x_offset, y_offset))
-                elif gravity == 'smart':
-
-                    # x was 76 when width was 620
-                    # now width is 100
-                    x_offset = (x_offset * float(self.image.width)) / float(org_w)
-                    y_offset = (y_offset * float(self.image.height)) / float(org_h)
-                    print("now x_offset", x_offset, y_offset)
-
-                    left = int(x_offset - float(wanted_width / 2.0))
-                    if left < 0:
-                        left = 0
-                    top = int(y_offset - float(wanted_height / 2.0))
-                    if top < 0:
-                        top = 0
-
-                    right = left + wanted_width
-                    bottom = top + wanted_height
-                    if bottom >= self.image.height:
-                        bottom = self.image.height
-                    if right >= self.image.width:
-                        right = self.image.width
-
-                    debug = False
-                    if debug:
-                        from wand.drawing import Drawing
-                        with Drawing() as draw:
-                            draw.fill_color = Color('rgb(255, 255, 255)')
-                            draw.circle((x_offset, y_offset), (50, 50))
-                            # draw.rectangle(left=x_offset, top=y_offset, width=50, height=50)
-                            # draw.rectangle(left=left, top=top, right=right, bottom=bottom)
-                            draw(self.image)
-                    self.image.crop(left=left, top=top, right=right, bottom=bottom)
-                elif gravity == 'top_left':
-                    self.image.transform(crop="%sx%s+%s+%s" % (wanted_width, wanted_height, 0, 0))
-
-            elif crop_x and crop_y and crop_width and crop_height:
-                self.image.transform(crop="%sx%s+%s+%s" % (crop_width, crop_height, crop_x, crop_y),
-                                     resize="%sx%s" % (wanted_width, wanted_height))
-
-                # -unsharp <radius>{x<sigma>}{+<amount>}{+<threshold>}
-                # That is, a radius is expected (or a leading "x" if omitted),
-                # followed by optional parameters sigma, amount and threshold.
-                # [Note that there is also a -sharpen option to convert. This is not an alias for
-                # -unsharp, and (I'm pretty sure) employs a different sharpening routine internally.]
-                #
-                # A typical call to convert might look something like the following:
-                #
-                # $ convert ... -unsharp 1.5x1.2+1.0+0.10 <input file> <output file>
-                # http://redskiesatnight.com/2005/04/06/sharpening-using-image-magick/
-                # disabling sharpening for now
-                # self.image.unsharp_mask(radius=0, sigma=1.4, amount=1.0, threshold=0.10)
-
-                # The post Image Resizing suggests using "-unsharp 0x0.75+0.75+0.008"
-                # as being good for images larger than 500 pixels.
-                # self.image.unsharp_mask(radius=0, sigma=0.75, amount=0.75, threshold=0.008)
-
+                self.image.transform(crop="%sx%s+%s+%s" % (wanted_width, wanted_height, x_offset, y_offset))
+            elif operation == 'background':
+                self.set_background(*args)
+            elif operation == 'fit_frame':
+                background_color, width, height, opacity = args
+                self.fit_frame(background_color, width=width, height=height, opacity=opacity, placement='center')
             else:
-                if preserve_ratio:
-                    self.image.transform(resize="%sx%s" % (wanted_width, wanted_height))
-                    # we do a sharpen
-                    # -unsharp <radius>{x<sigma>}{+<amount>}{+<threshold>}
-                    # now
-                    # disabling sharpening now
-                    # self.image.unsharp_mask(radius=0, sigma=1.4, amount=1.0, threshold=0.10)
-                    # -unsharp 10x4+1+0
-                    # 10x4
-                    # self.image.unsharp_mask(radius=10, sigma=4, amount=1.0, threshold=0)
-
-                    # 10x2
-                    # self.image.unsharp_mask(radius=10, sigma=2, amount=1, threshold=0)
-
-                    # amt-0.8.jpg
-                    # self.image.unsharp_mask(radius=0, sigma=2, amount=1.2, threshold=0)
-
-                    # sigma 2.4
-                    # self.image.unsharp_mask(radius=0, sigma=2.4, amount=1.2, threshold=0)
-
-                    # self.image.unsharp_mask(radius=0, sigma=2.4, amount=0.8, threshold=0)
-
-                    # create a background image so we can blend better, this is needed for jpg output,
-                    # if its already png we dont put a frame
-                    color_rgb = self.hex_to_int('#%s' % frame_bg_color)
-                    transp = 1 - (opacity / 100.0)
-                    color_rgba_string = 'rgba(%s, %s, %s, %s)' % (color_rgb[0], color_rgb[1], color_rgb[2], transp)
-                    color = Color(color_rgba_string)
-                    cover = Image(width=self.image.width, height=self.image.height, background=color)
-                    for k in self.image.profiles:
-                        value = self.image.profiles[k]
-                        if value is not None:
-                            cover.profiles[k] = value
-                    # now blend it
-                    cover.composite(self.image, 0, 0)
-                    self.image = cover
-                else:
-                    self.image.transform(resize="%s!x%s!" % (wanted_width, wanted_width))
-
-        elif wanted_width:
-            self.image.transform(resize="%sx" % wanted_width)
-
-        elif wanted_height:
-            self.image.transform(resize="x%s" % wanted_height)
-
-        if resize_then_fit:
-            self.fit_frame('#%s' % frame_bg_color,
-                           width=wanted_width,
-                           height=wanted_height,
-                           opacity=opacity,
-                           placement='center',
-                           composite_x=0,
-                           composite_y=0)
+                raise ValueError('Unknown operation %s' % operation)
 
     def save(self, file_name, compression_quality=75):
         self.image.compression_quality = compression_quality
@@ -353,11 +270,21 @@ class ImageOperator(object):
         self.image.save(filename=file_name)
 
     def write(self, file, fmt=None):
-        print('format: %s' % self.image.format)
+        logger.debug('format: %s', self.image.format)
         if fmt:
             self.image.format = fmt
         self.image.save(file=file)
 
+    def write_premultiplied_png(self, file):
+        """
+        Writes the image as a PNG with premultiplied alpha, working on the raw pixels of the image
+        without encoding and decoding it first.
+        """
+        pixels = export_rgba_pixels(self.image)
+        premultiply_alpha(pixels)
+        height, width, _ = pixels.shape
+        Img.frombuffer('RGBA', (width, height), pixels, 'raw', 'RGBA', 0, 1).save(file, 'png')
+
     def save_premultiplied_png(self, file_name):
         """
         this should run after save() as i couldnt find a better way to load image to PIL
@@ -380,28 +307,206 @@ class ImageOperator(object):
         im = Img.fromstring("RGBA", im.size, a.tostring())
         im.save(file_name)
 
-    def smart_crop(self, file_name, wanted_width, wanted_height, **kwargs):
-        raise NotImplementedError()
+    def smart_crop(self, geometry, **options):
+        options['gravity'] = 'smart'
+        return self.resize_then_crop(geometry, **options)
+
+    def find_smart_crop(self, width, height):
+        """
+        Returns the origin of the width x height window of the image with the most saliency.
+        The saliency is computed on a small proxy of the image and the window mapped back to the image.
+        """
+        with self.image.clone() as proxy:
+            if max(proxy.size) > PROXY_SIZE:
+                proxy.transform(resize='%ix%i' % (PROXY_SIZE, PROXY_SIZE))
+            scale_x = self.image.width / float(proxy.width)
+            scale_y = self.image.height / float(proxy.height)
+            x, y = best_window(saliency(export_rgba_pixels(proxy)), width / scale_x, height / scale_y)
+        x = max(0, min(int(round(x * scale_x)), self.image.width - width))
+        y = max(0, min(int(round(y * scale_y)), self.image.height - height))
+        logger.debug("smart crop %sx%s+%s+%s", width, height, x, y)
+        return x, y
+
+
+def validate_filters(filters):
+    """
+    Checks the filters parameter is a list of known filters with known parameters,
+    raising ValueError otherwise.
+    """
+    if not isinstance(filters, list):
+        raise ValueError('filters should be a list')
+    for f in filters:
+        if not isinstance(f, dict) or f.get('id') not in FILTERS:
+            raise ValueError('unknown filter %s' % (f.get('id') if isinstance(f, dict) else f))
+        parameters = inspect.signature(getattr(ImageOperator, f['id'])).parameters
+        params = {k.replace('-', '_'): v for k, v in f.items() if k != 'id'}
+        for name, parameter in parameters.items():
+            if name != 'self' and parameter.default is inspect.Parameter.empty and name not in params:
+                raise ValueError('%s is required for %s' % (name, f['id']))
+        for name, value in params.items():
+            if name == 'self' or name not in parameters:
+                raise ValueError('unknown parameter %s for %s' % (name, f['id']))
+            default = parameters[name].default
+            if default is inspect.Parameter.empty or isinstance(default, str):
+                if not isinstance(value, str):
+                    raise ValueError('%s should be a string' % name)
+                if name.endswith('_color') and not HEX_COLOR.match(value):
+                    raise ValueError('%s should be a hex color' % name)
+            elif value is None and default is None:
+                continue
+            elif name.startswith('composite_') and (isinstance(value, bool) or not isinstance(value, int)):
+                raise ValueError('%s should be an integer' % name)
+            elif isinstance(value, bool) or not isinstance(value, (int, float)) or math.isnan(value):
+                raise ValueError('%s should be a number' % name)
+            elif not 0 <= value <= FILTER_PARAMETER_LIMITS[name]:
+                raise ValueError('%s should be between 0 and %s' % (name, FILTER_PARAMETER_LIMITS[name]))
+
+
+def plan_filters(filters):
+    """
+    Returns the filters as a list of (filter, params) with parameter names as python identifiers.
+
+    Consecutive translucent filters covering the whole image are fused into one: blurs and
+    blending with a color commute, the blurs add up to a single blur and the colors to a single color.
+    """
+    planned = []
+    for f in filters:
+        filter_id = f['id']
+        params = {k.replace('-', '_'): v for k, v in f.items() if k != 'id'}
+        full = not any(params.get(k) for k in ('composite_width', 'composite_height', 'composite_x', 'composite_y'))
+        if filter_id == 'translucent' and full and planned and planned[-1][0] == 'translucent' and planned[-1][2]:
+            planned[-1] = ('translucent', _fuse_translucent(planned[-1][1], params), True)
+        else:
+            planned.append((filter_id, params, filter_id == 'translucent' and full))
+    return [(filter_id, params) for filter_id, params, _ in planned]
+
+
+def _fuse_translucent(first, second):
+    defaults = {k: v.default for k, v in inspect.signature(ImageOperator.translucent).parameters.items()}
+    first = dict(defaults, **first)
+    second = dict(defaults, **second)
+    a1 = 1 - first['opacity'] / 100.0
+    a2 = 1 - second['opacity'] / 100.0
+    alpha = 1 - (1 - a1) * (1 - a2)
+    c1 = ImageOperator.hex_to_int(first['background_color'])
+    c2 = ImageOperator.hex_to_int(second['background_color'])
+    if alpha:
+        color = [int(round(((1 - a2) * a1 * x1 + a2 * x2) / alpha)) for x1, x2 in zip(c1, c2)]
+    else:
+        color = c2
+    return {
+        'background_color': '#%02X%02X%02X' % tuple(color),
+        'opacity': (1 - alpha) * 100,
+        'radius': first['radius'] + second['radius'],
+        'sigma': math.hypot(first['sigma'], second['sigma']),
+    }
+
+
+def plan_resize(width, height, geometry,
+                preserve_ratio=True,
+                resize_then_crop=False,
+                resize_then_fit=False,
+                crop_x=0, crop_y=0, crop_width=0, crop_height=0,
+                frame_bg_color='FFF', opacity=100,
+                gravity='top_left'):
+    """
+    Plans the operations of ImageOperator.resize for an oriented image of the given width and height.
+
+    Returns a list of operations for ImageOperator.apply:
+    ('transform', crop, resize) crops and/or resizes with ImageMagick geometry strings,
+    ('crop', width, height, gravity) crops the resized image to the wanted size,
+    ('background', color, opacity) blends the image over a background color,
+    ('fit_frame', color, width, height, opacity) centers the image on a canvas of the given size.
+    """
+    wanted_width = geometry[0]
+    wanted_height = geometry[1]
+    if wanted_width:
+        assert int(wanted_width) < 10000
+    if wanted_height:
+        assert int(wanted_height) < 10000
+
+    assert gravity in ('center', 'top_left', 'smart')
+
+    operations = []
+    if wanted_width and wanted_height:
+        if resize_then_crop:
+            if height < wanted_height and width < wanted_width:
+                # this is upscaling
+                next_height = wanted_width * (height / float(width))
+                if next_height >= wanted_height:
+                    operations.append(('transform', '', "%sx" % wanted_width))
+                else:
+                    operations.append(('transform', '', "x%s" % wanted_height))
+            else:
+                # this is downscaling
+                ratio = width / float(height)
+                new_width = wanted_height * ratio
+                new_height = wanted_width / ratio
+                if new_height >= wanted_height:
+                    thumbnail_width = wanted_width
+                    thumbnail_height = new_height
+                else:
+                    thumbnail_height = wanted_height
+                    thumbnail_width = new_width
+                thumbnail_width = int(round(thumbnail_width))
+                thumbnail_height = int(round(thumbnail_height))
+                operations.append(('transform', '', "%ix%i" % (thumbnail_width, thumbnail_height)))
+            operations.append(('crop', wanted_width, wanted_height, gravity))
 
+        elif crop_x and crop_y and crop_width and crop_height:
+            operations.append(('transform',
+                               "%sx%s+%s+%s" % (crop_width, crop_height, crop_x, crop_y),
+                               "%sx%s" % (wanted_width, wanted_height)))
 
-def convert_to_premultiplied_png(file):
+        elif preserve_ratio:
+            operations.append(('transform', '', "%sx%s" % (wanted_width, wanted_height)))
+            # blend with the background color, this is needed for jpg output
+            operations.append(('background', '#%s' % frame_bg_color, opacity))
+
+        else:
+            # Note: this uses the width for both dimensions. Fixing it would change existing derivatives.
+            operations.append(('transform', '', "%s!x%s!" % (wanted_width, wanted_width)))
+
+    elif wanted_width:
+        operations.append(('transform', '', "%sx" % wanted_width))
+
+    elif wanted_height:
+        operations.append(('transform', '', "x%s" % wanted_height))
+
+    if resize_then_fit:
+        operations.append(('fit_frame', '#%s' % frame_bg_color, wanted_width, wanted_height, opacity))
+    return operations
+
+
+def export_rgba_pixels(image):
+    """
+    Exports the pixels of a wand image into a new (height, width, 4) uint8 RGBA array.
+    Images without an alpha channel are exported as opaque.
+    """
+    if image.colorspace not in ('srgb', 'rgb', 'gray'):
+        image.transform_colorspace('srgb')
+    width, height = image.size
+    pixels = numpy.empty((height, width, 4), dtype=numpy.uint8)
+    r = library.MagickExportImagePixels(image.wand, 0, 0, width, height, b'RGBA',
+                                        STORAGE_TYPES.index('char'),
+                                        pixels.ctypes.data_as(ctypes.c_void_p))
+    if not r:
+        image.raise_exception()
+    return pixels
+
+
+def premultiply_alpha(pixels, chunk_rows=256):
     """
-    http://stackoverflow.com/questions/6591361/method-for-converting-pngs-to-premultiplied-alpha
+    Multiplies the colour channels of a (height, width, 4) uint8 RGBA array by its alpha channel in place.
 
+    Works on chunks of rows with uint16 intermediates, so the extra memory used is
+    independent of the image height.
     """
-    logger.info("converting to premultiplied alpha")
-    im = Img.open(file).convert('RGBA')
-    a = numpy.fromstring(im.tobytes(), dtype=numpy.uint8)
-    a = a.astype(numpy.float64)
-    alpha_layer = a[3::4] / 255.0
-    a[::4] *= alpha_layer
-    a[1::4] *= alpha_layer
-    a[2::4] *= alpha_layer
-    im = Img.frombytes("RGBA", im.size, a.astype(numpy.uint8).tostring())
-    f = BytesIO()
-    im.save(f, 'png')
-    f.seek(0)
-    return f
+    for start in range(0, pixels.shape[0], chunk_rows):
+        chunk = pixels[start:start + chunk_rows]
+        rgb = chunk[..., :3] * chunk[..., 3:].astype(numpy.uint16)
+        rgb //= 255
+        chunk[..., :3] = rgb
 
 
 if __name__ == "__main__":
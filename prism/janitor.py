@@ -0,0 +1,96 @@
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TempDirJanitor(object):
+    """
+    Gives each worker its own ImageMagick temporary directory under `base_dir` and removes
+    files older than `max_age` seconds from it in a background thread every `interval` seconds.
+
+    The directory is named after the process id and set as MAGICK_TEMPORARY_PATH, which
+    ImageMagick reads whenever it creates a temporary file. Render processes inherit it.
+    The directories of workers that are gone are removed by the next sweep of any worker.
+    """
+
+    def __init__(self, base_dir, max_age=300, interval=60):
+        self.base_dir = base_dir
+        self.max_age = max_age
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.removed_files = 0
+        self.removed_dirs = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+    @property
+    def path(self):
+        return os.path.join(self.base_dir, str(os.getpid()))
+
+    def start(self):
+        """
+        Creates the directory of this worker and starts its janitor thread. Cheap to call on every
+        request: threads don't survive a fork, so this only does something once per process.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            path = self.path
+            os.makedirs(path, exist_ok=True)
+            os.environ['MAGICK_TEMPORARY_PATH'] = path
+            self.files = self.bytes = 0
+            self._pid = os.getpid()
+            threading.Thread(target=self._sweep_forever, name='tmp-janitor', daemon=True).start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Failed to clean %s", self.base_dir)
+
+    def sweep(self):
+        """
+        Removes the old files of this worker and the directories of dead workers, and updates the
+        counts of the files left.
+        """
+        now = time.time()
+        files = 0
+        size = 0
+        for entry in os.scandir(self.path):
+            try:
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime < now - self.max_age:
+                    os.remove(entry.path)
+                    self.removed_files += 1
+                else:
+                    files += 1
+                    size += stat.st_size
+            except FileNotFoundError:
+                pass
+        self.files = files
+        self.bytes = size
+
+        for entry in os.scandir(self.base_dir):
+            if entry.name.isdigit() and entry.is_dir(follow_symlinks=False) and not pid_exists(int(entry.name)):
+                logger.info("Removing the temporary files of a dead worker in %s", entry.path)
+                shutil.rmtree(entry.path, ignore_errors=True)
+                self.removed_dirs += 1
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
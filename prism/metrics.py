@@ -0,0 +1,169 @@
+import contextlib
+import os
+import threading
+import time
+from collections import defaultdict
+
+# Histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+_lock = threading.Lock()
+# (stage, customer, command, backend) -> [bucket counts..., +Inf count, sum]
+_histograms = defaultdict(lambda: [0] * (len(BUCKETS) + 1) + [0.0])
+_gauges = {}
+# Qualities chosen by quality=auto
+QUALITY_BUCKETS = (40, 50, 60, 70, 80, 90, 95, 100)
+_qualities = defaultdict(lambda: [0] * (len(QUALITY_BUCKETS) + 1) + [0.0])
+
+
+def start_request():
+    """
+    Starts collecting the timings of the current request in this thread.
+    """
+    _local.timings = []
+    _local.qualities = []
+    _local.labels = {'customer': '', 'command': '', 'backend': ''}
+    _local.start = time.perf_counter()
+
+
+def set_labels(**labels):
+    """
+    Sets the customer, command and/or render backend the timings of the current request are aggregated by.
+    """
+    if getattr(_local, 'labels', None) is not None:
+        _local.labels.update({k: v or '' for k, v in labels.items()})
+
+
+def get_labels():
+    """
+    Returns the labels set for the current request.
+    """
+    return dict(getattr(_local, 'labels', None) or {})
+
+
+def finish_request():
+    """
+    Stops collecting timings for the current request and returns them as a list of (stage, seconds).
+    """
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        return []
+    observe('total', time.perf_counter() - _local.start)
+    _local.timings = None
+    return timings
+
+
+def observe(stage, seconds):
+    """
+    Records the duration of a stage in the current request (if any) and in the histograms.
+    """
+    labels = getattr(_local, 'labels', None) or {}
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings.append((stage, seconds))
+    key = (stage, labels.get('customer', ''), labels.get('command', ''), labels.get('backend', ''))
+    with _lock:
+        _add(_histograms[key], BUCKETS, seconds)
+
+
+def _add(histogram, buckets, value):
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            histogram[i] += 1
+            break
+    else:
+        histogram[len(buckets)] += 1
+    histogram[-1] += value
+
+
+@contextlib.contextmanager
+def timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def observe_quality(quality):
+    """
+    Records the quality chosen for an image rendered with quality=auto.
+    """
+    labels = getattr(_local, 'labels', None) or {}
+    qualities = getattr(_local, 'qualities', None)
+    if qualities is not None and getattr(_local, 'timings', None) is not None:
+        qualities.append(quality)
+    with _lock:
+        _add(_qualities[labels.get('customer', '')], QUALITY_BUCKETS, quality)
+
+
+def get_qualities():
+    """
+    Returns the qualities chosen with quality=auto in the current request.
+    """
+    return list(getattr(_local, 'qualities', None) or [])
+
+
+def register_gauge(name, description, fn):
+    """
+    Registers a function returning the current value of a metric, exported on every scrape.
+    """
+    _gauges[name] = (description, fn)
+
+
+def server_timing_header(timings):
+    """
+    Formats timings as a Server-Timing header value. Stages that happen several times are summed.
+    """
+    durations = {}
+    for stage, seconds in timings:
+        durations[stage] = durations.get(stage, 0) + seconds
+    return ', '.join('%s;dur=%.1f' % (stage, seconds * 1000) for stage, seconds in durations.items())
+
+
+def _histogram_lines(name, labels, buckets, histogram):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(buckets, histogram):
+        cumulative += count
+        lines.append('%s_bucket{%s,le="%s"} %i' % (name, labels, bound, cumulative))
+    cumulative += histogram[len(buckets)]
+    lines.append('%s_bucket{%s,le="+Inf"} %i' % (name, labels, cumulative))
+    lines.append('%s_sum{%s} %f' % (name, labels, histogram[-1]))
+    lines.append('%s_count{%s} %i' % (name, labels, cumulative))
+    return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus():
+    """
+    Returns the metrics of this worker in the Prometheus text exposition format.
+    """
+    worker = os.getpid()
+    lines = [
+        '# HELP prism_stage_duration_seconds Duration of each stage of handling a request.',
+        '# TYPE prism_stage_duration_seconds histogram',
+    ]
+    with _lock:
+        histograms = {k: list(v) for k, v in _histograms.items()}
+    for (stage, customer, command, backend), histogram in sorted(histograms.items()):
+        labels = 'worker="%s",backend="%s",stage="%s",customer="%s",command="%s"' % (
+            worker, _escape(backend), _escape(stage), _escape(customer), _escape(command))
+        lines += _histogram_lines('prism_stage_duration_seconds', labels, BUCKETS, histogram)
+    with _lock:
+        qualities = {k: list(v) for k, v in _qualities.items()}
+    if qualities:
+        lines.append('# HELP prism_auto_quality Quality chosen for images rendered with quality=auto.')
+        lines.append('# TYPE prism_auto_quality histogram')
+    for customer, histogram in sorted(qualities.items()):
+        labels = 'worker="%s",customer="%s"' % (worker, _escape(customer))
+        lines += _histogram_lines('prism_auto_quality', labels, QUALITY_BUCKETS, histogram)
+    for name, (description, fn) in sorted(_gauges.items()):
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s{worker="%s"} %s' % (name, worker, fn()))
+    return '\n'.join(lines) + '\n'
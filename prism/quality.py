@@ -0,0 +1,77 @@
+import logging
+import time
+from io import BytesIO
+
+import numpy
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# SSIM stabilising constants for 8 bit images
+C1 = (0.01 * 255) ** 2
+C2 = (0.03 * 255) ** 2
+
+
+def luma(pixels):
+    """
+    Returns the luma of an (height, width, 3 or 4) uint8 array as a float array.
+    RGBA pixels are weighted by their alpha, so the colour of transparent pixels is ignored.
+    """
+    pixels = pixels.astype(numpy.float64)
+    y = pixels[..., 0] * 0.299 + pixels[..., 1] * 0.587 + pixels[..., 2] * 0.114
+    if pixels.shape[-1] == 4:
+        y *= pixels[..., 3] / 255.0
+    return y
+
+
+def _box_mean(x, window):
+    """
+    Returns the means of all window x window blocks of x, using summed area tables.
+    """
+    s = numpy.zeros((x.shape[0] + 1, x.shape[1] + 1))
+    s[1:, 1:] = x.cumsum(0).cumsum(1)
+    return (s[window:, window:] - s[:-window, window:] - s[window:, :-window] + s[:-window, :-window]) / (window * window)
+
+
+def ssim(reference, candidate, window=8):
+    """
+    Returns the mean structural similarity of the luma of two images of the same size,
+    over square windows of the given size.
+    """
+    a = luma(reference)
+    b = luma(candidate)
+    window = max(1, min(window, a.shape[0], a.shape[1]))
+    mu_a = _box_mean(a, window)
+    mu_b = _box_mean(b, window)
+    var_a = _box_mean(a * a, window) - mu_a * mu_a
+    var_b = _box_mean(b * b, window) - mu_b * mu_b
+    cov = _box_mean(a * b, window) - mu_a * mu_b
+    s = ((2 * mu_a * mu_b + C1) * (2 * cov + C2)) / ((mu_a * mu_a + mu_b * mu_b + C1) * (var_a + var_b + C2))
+    return float(s.mean())
+
+
+def search_quality(encode, reference, target, min_quality=40, max_quality=95, time_budget=0.5):
+    """
+    Finds the lowest quality whose output has at least the target SSIM to the reference pixels.
+
+    `encode(quality)` returns the encoded bytes at a quality. Qualities are bisected until the
+    search converges or runs out of its time budget in seconds. Returns the chosen quality and
+    its encoded bytes, which are encoded at max_quality if no tried quality met the target.
+    """
+    deadline = time.monotonic() + time_budget
+    best = None
+    low, high = min_quality, max_quality
+    while low <= high and time.monotonic() < deadline:
+        quality = (low + high) // 2
+        data = encode(quality)
+        candidate = numpy.asarray(Image.open(BytesIO(data)).convert('RGBA' if reference.shape[-1] == 4 else 'RGB'))
+        score = ssim(reference, candidate)
+        logger.debug("quality %s ssim %.4f", quality, score)
+        if score >= target:
+            best = (quality, data)
+            high = quality - 1
+        else:
+            low = quality + 1
+    if best is None:
+        best = (max_quality, encode(max_quality))
+    return best
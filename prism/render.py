@@ -0,0 +1,170 @@
+import logging
+import multiprocessing
+import resource
+import threading
+from io import BytesIO
+
+import prism.backends as backends
+import prism.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds a new render process may take to start and import its modules
+STARTUP_TIMEOUT = 60
+
+
+class RenderTimeoutError(Exception):
+    message = 'Rendering the image took too long.'
+
+
+class RenderProcessError(Exception):
+    message = 'The render process died while rendering the image.'
+
+
+def render_original(data, cmd, options, size_hint=None, backend=None):
+    """
+    Decodes the original and renders the derivative. Runs in a render process.
+    Returns the rendered bytes and the backend that rendered them.
+    """
+    f, backend = backends.render(data, cmd, options, size_hint=size_hint, backend=backend)
+    return f.getvalue(), backend
+
+
+def serve(conn):
+    """
+    Runs the jobs received on the connection until it is closed. Runs in a render process.
+    Sends back whether each job succeeded, its result or exception, the peak RSS of the process in bytes
+    and the stage timings, metric labels (such as the backend) and auto qualities of the job.
+    """
+    conn.send('ready')
+    while True:
+        try:
+            fn, args = conn.recv()
+        except EOFError:
+            return
+        metrics.start_request()
+        try:
+            ok, result = True, fn(*args)
+        except Exception as e:
+            ok, result = False, e
+        labels = {k: v for k, v in metrics.get_labels().items() if v}
+        qualities = metrics.get_qualities()
+        timings = [(stage, seconds) for stage, seconds in metrics.finish_request() if stage != 'total']
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        try:
+            conn.send((ok, result, rss, timings, labels, qualities))
+        except Exception as e:
+            # the result or exception can't be pickled
+            conn.send((False, RuntimeError(repr(e)), rss, timings, labels, qualities))
+
+
+class RenderProcess(object):
+    """
+    A render process running one job at a time, connected to the worker by a pipe.
+    """
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=serve, args=(child_conn,), name='render', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        if not self.conn.poll(STARTUP_TIMEOUT) or self.conn.recv() != 'ready':
+            self.kill()
+            raise RenderProcessError
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        # the process exits once the pipe is closed
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+
+
+class RenderEngine(object):
+    """
+    Renders images in a bounded set of processes so CPU bound ImageMagick work does not hold
+    the threads that wait on S3.
+
+    Each job runs in its own process, so a job that takes longer than `timeout` seconds (from
+    when its process starts it, not while it waits for a free process) or crashes only takes
+    down its own process. Render processes are replaced after `max_jobs` jobs or when they
+    grow above `max_rss` bytes.
+    """
+
+    def __init__(self, processes, timeout=30, max_jobs=100, max_rss=0):
+        self.processes = processes
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        # forking a threaded uwsgi worker is not safe
+        self._context = multiprocessing.get_context('spawn')
+        self._slots = threading.BoundedSemaphore(processes)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> RenderProcess:
+        with self._lock:
+            while self._idle:
+                process = self._idle.pop()
+                if process.process.is_alive():
+                    return process
+                process.kill()
+        return RenderProcess(self._context)
+
+    def _release(self, process, rss):
+        process.jobs += 1
+        if self.max_rss and rss > self.max_rss:
+            logger.warning("Render process uses %i bytes, replacing it", rss)
+            process.stop()
+        elif self.max_jobs and process.jobs >= self.max_jobs:
+            process.stop()
+        else:
+            with self._lock:
+                self._idle.append(process)
+
+    def run(self, fn, *args):
+        """
+        Runs `fn(*args)` in a render process and returns its result or raises its exception.
+        The stage timings, labels and auto qualities of the job are recorded in this process.
+        """
+        with self._slots:
+            process = self._acquire()
+            try:
+                process.conn.send((fn, args))
+                if not process.conn.poll(self.timeout):
+                    logger.error("Render timed out after %ss, killing its process", self.timeout)
+                    process.kill()
+                    raise RenderTimeoutError
+                ok, result, rss, timings, labels, qualities = process.conn.recv()
+            except (EOFError, OSError):
+                logger.error("A render process died, replacing it")
+                process.kill()
+                raise RenderProcessError
+            self._release(process, rss)
+        metrics.set_labels(**labels)
+        for stage, seconds in timings:
+            metrics.observe(stage, seconds)
+        for quality in qualities:
+            metrics.observe_quality(quality)
+        if not ok:
+            raise result
+        return result
+
+    def render(self, data, cmd, options, size_hint=None, backend=None) -> BytesIO:
+        result, _ = self.run(render_original, data, cmd, options, size_hint, backend)
+        return BytesIO(result)
+
+    def close(self):
+        """
+        Stops the idle render processes.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for process in idle:
+            process.stop()
@@ -0,0 +1,62 @@
+import numpy
+
+# Saliency is computed on a proxy of the image at most this large
+PROXY_SIZE = 128
+
+# Weights of the features of the saliency map
+EDGE_WEIGHT = 1.0
+SKIN_WEIGHT = 0.5
+SATURATION_WEIGHT = 0.1
+# Normalised RGB of skin tones
+SKIN_COLOR = numpy.array([0.78, 0.57, 0.44])
+SKIN_THRESHOLD = 0.8
+
+
+def saliency(pixels):
+    """
+    Returns an attention map for a (height, width, 3 or 4) uint8 array: a float array of the same
+    height and width where larger values mark the parts of the image people are more likely to look at.
+
+    It combines edge energy (detail), closeness to skin tones and saturation, weighted by alpha.
+    """
+    rgb = pixels[..., :3].astype(numpy.float64) / 255
+    luma = rgb @ numpy.array([0.299, 0.587, 0.114])
+
+    # edge energy, the absolute laplacian of the luma
+    padded = numpy.pad(luma, 1, mode='edge')
+    edges = numpy.abs(4 * luma - padded[:-2, 1:-1] - padded[2:, 1:-1] - padded[1:-1, :-2] - padded[1:-1, 2:])
+
+    # skin tones, by the distance of the normalised colour to SKIN_COLOR, for reasonably lit pixels
+    norm = numpy.sqrt((rgb * rgb).sum(axis=-1, keepdims=True))
+    distance = numpy.sqrt(((rgb / numpy.maximum(norm, 1e-6) - SKIN_COLOR) ** 2).sum(axis=-1))
+    skin = numpy.clip((1 - distance - SKIN_THRESHOLD) / (1 - SKIN_THRESHOLD), 0, 1)
+    skin *= (luma > 0.2) & (luma < 0.9)
+
+    # saturation of vivid, not too dark or light colours
+    saturation = rgb.max(axis=-1) - rgb.min(axis=-1)
+    saturation *= (luma > 0.05) & (luma < 0.95)
+
+    attention = EDGE_WEIGHT * edges + SKIN_WEIGHT * skin + SATURATION_WEIGHT * saturation
+    if pixels.shape[-1] == 4:
+        attention *= pixels[..., 3] / 255.0
+    return attention
+
+
+def best_window(attention, width, height):
+    """
+    Returns the (x, y) origin of the width x height window of the attention map with the most attention.
+    Windows are scored with a summed area table, so every position is considered. Ties favour the center.
+    """
+    rows, cols = attention.shape
+    width = max(1, min(int(round(width)), cols))
+    height = max(1, min(int(round(height)), rows))
+    s = numpy.zeros((rows + 1, cols + 1))
+    s[1:, 1:] = attention.cumsum(0).cumsum(1)
+    scores = s[height:, width:] - s[:-height, width:] - s[height:, :-width] + s[:-height, :-width]
+    # a slight preference for the center
+    ys = numpy.arange(scores.shape[0]) - (scores.shape[0] - 1) / 2.0
+    xs = numpy.arange(scores.shape[1]) - (scores.shape[1] - 1) / 2.0
+    distance = numpy.add.outer(ys * ys / max(rows * rows, 1), xs * xs / max(cols * cols, 1))
+    scores = scores - distance * (scores.max() - scores.min() + 1e-9) * 0.1
+    y, x = numpy.unravel_index(numpy.argmax(scores), scores.shape)
+    return int(x), int(y)
@@ -12,3 +12,113 @@ SECRETS_BUCKET = os.environ.get('SECRETS_BUCKET')
 DEFAULT_CUSTOMER = os.environ.get('DEFAULT_CUSTOMER')
 AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
+
+# HTTP connection pooling for S3 GET/HEAD requests
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '10'))
+HTTP_KEEP_ALIVE = os.environ.get('HTTP_KEEP_ALIVE', 'true').lower() == 'true'
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '5'))
+HTTP_RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', '0.1'))
+
+# In-process cache of rendered derivatives known to exist (or be missing) in the write bucket
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', '10000'))
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', '300'))
+RESULT_CACHE_NEGATIVE_TTL = int(os.environ.get('RESULT_CACHE_NEGATIVE_TTL', '5'))
+
+# Coalescing of concurrent renders of the same derivative
+RENDER_COALESCE_TIMEOUT = int(os.environ.get('RENDER_COALESCE_TIMEOUT', '30'))
+RENDER_LOCK_DIR = os.environ.get('RENDER_LOCK_DIR')  # set to also coalesce across uwsgi workers
+
+# Local disk cache of original images shared by all workers on a host
+ORIGINALS_CACHE_DIR = os.environ.get('ORIGINALS_CACHE_DIR')  # disabled if not set
+ORIGINALS_CACHE_SIZE = int(os.environ.get('ORIGINALS_CACHE_SIZE', str(1024 * 1024 * 1024)))
+
+# Cache of the bytes of frequently requested derivatives shared by all workers on a host, ideally on a tmpfs.
+# Derivatives are admitted once they were requested HOT_CACHE_MIN_REQUESTS times recently and are served
+# from the cache for HOT_CACHE_TTL seconds without any request to S3. Request counts are kept per worker,
+# so with N workers admission can take up to N * HOT_CACHE_MIN_REQUESTS requests.
+HOT_CACHE_DIR = os.environ.get('HOT_CACHE_DIR')  # disabled if not set
+HOT_CACHE_SIZE = int(os.environ.get('HOT_CACHE_SIZE', str(256 * 1024 * 1024)))
+HOT_CACHE_MAX_ITEM_BYTES = int(os.environ.get('HOT_CACHE_MAX_ITEM_BYTES', str(512 * 1024)))
+HOT_CACHE_MIN_REQUESTS = int(os.environ.get('HOT_CACHE_MIN_REQUESTS', '3'))
+HOT_CACHE_TTL = int(os.environ.get('HOT_CACHE_TTL', '3600'))
+
+# Rendering several derivatives of one original with cmd=batch
+BATCH_MAX_VARIANTS = int(os.environ.get('BATCH_MAX_VARIANTS', '20'))
+BATCH_UPLOAD_THREADS = int(os.environ.get('BATCH_UPLOAD_THREADS', '4'))
+
+# Decode JPEGs at a reduced scale when the output is at least this many times smaller (0 disables)
+DECODE_SIZE_HINT_FACTOR = float(os.environ.get('DECODE_SIZE_HINT_FACTOR', '2'))
+
+# Originals larger than this many bytes are rejected while downloading them (0 disables the check)
+MAX_ORIGINAL_BYTES = int(os.environ.get('MAX_ORIGINAL_BYTES', str(100 * 1024 * 1024)))
+
+# Originals with more pixels than this are rejected before decoding (0 disables the check)
+MAX_ORIGINAL_PIXELS = int(os.environ.get('MAX_ORIGINAL_PIXELS', str(100 * 1000 * 1000)))
+
+# ImageMagick resource limits per worker, in bytes (memory, map), pixels (area) and threads.
+# Unset limits use the ImageMagick defaults.
+MAGICK_RESOURCE_LIMITS = {
+    'memory': int(os.environ.get('MAGICK_MEMORY_LIMIT', '0')),
+    'map': int(os.environ.get('MAGICK_MAP_LIMIT', '0')),
+    'area': int(os.environ.get('MAGICK_AREA_LIMIT', '0')),
+    'thread': int(os.environ.get('MAGICK_THREAD_LIMIT', '0')),
+}
+
+# ImageMagick temporary files go to a directory per worker under MAGICK_TMP_DIR (ideally a tmpfs) and are
+# removed by a background thread every MAGICK_TMP_CLEAN_INTERVAL seconds once older than MAGICK_TMP_MAX_AGE seconds.
+# An empty MAGICK_TMP_DIR leaves the temporary files to ImageMagick.
+MAGICK_TMP_DIR = os.environ.get('MAGICK_TMP_DIR', '/tmp/prism-magick')
+MAGICK_TMP_MAX_AGE = int(os.environ.get('MAGICK_TMP_MAX_AGE', '300'))
+MAGICK_TMP_CLEAN_INTERVAL = int(os.environ.get('MAGICK_TMP_CLEAN_INTERVAL', '60'))
+
+# Render images in a pool of processes instead of the request threads (0 disables)
+RENDER_PROCESSES = int(os.environ.get('RENDER_PROCESSES', '0'))
+RENDER_TIMEOUT = int(os.environ.get('RENDER_TIMEOUT', '30'))
+RENDER_MAX_JOBS_PER_PROCESS = int(os.environ.get('RENDER_MAX_JOBS_PER_PROCESS', '100'))
+RENDER_MAX_RSS = int(os.environ.get('RENDER_MAX_RSS', '0'))  # bytes, 0 disables
+
+# Return freshly rendered images directly instead of redirecting to S3, uploading them in the background
+SERVE_ON_MISS = os.environ.get('SERVE_ON_MISS', 'false').lower() == 'true'
+RENDER_CACHE_CONTROL = os.environ.get('RENDER_CACHE_CONTROL', 'public, max-age=31536000')
+UPLOAD_THREADS = int(os.environ.get('UPLOAD_THREADS', '4'))
+UPLOAD_QUEUE_SIZE = int(os.environ.get('UPLOAD_QUEUE_SIZE', '100'))
+UPLOAD_RETRIES = int(os.environ.get('UPLOAD_RETRIES', '3'))
+
+# The info command reads the headers of the original with ranged GETs of this many bytes, growing up to
+# INFO_RANGE_MAX_BYTES, instead of downloading the whole file (0 disables)
+INFO_RANGE_BYTES = int(os.environ.get('INFO_RANGE_BYTES', '65536'))
+INFO_RANGE_MAX_BYTES = int(os.environ.get('INFO_RANGE_MAX_BYTES', str(1024 * 1024)))
+
+# Store the dimensions of rendered images and the info of their originals with them,
+# so with_info requests for existing images are answered without rendering them again
+RESULT_INFO = os.environ.get('RESULT_INFO', 'true').lower() == 'true'
+
+# Resize GIFs to animated WebP for clients that accept WebP, instead of redirecting to the original GIF.
+# Larger GIFs are rejected.
+RESIZE_GIFS = os.environ.get('RESIZE_GIFS', 'false').lower() == 'true'
+GIF_MAX_FRAMES = int(os.environ.get('GIF_MAX_FRAMES', '500'))
+GIF_MAX_PIXELS = int(os.environ.get('GIF_MAX_PIXELS', str(500 * 1000 * 1000)))  # summed over all frames
+
+# quality=auto encodes JPEG and WebP at the lowest quality between AUTO_QUALITY_MIN and AUTO_QUALITY_MAX
+# whose SSIM to the unencoded image is at least AUTO_QUALITY_TARGET, searching for at most
+# AUTO_QUALITY_TIME_BUDGET seconds per image
+AUTO_QUALITY_TARGET = float(os.environ.get('AUTO_QUALITY_TARGET', '0.985'))
+AUTO_QUALITY_MIN = int(os.environ.get('AUTO_QUALITY_MIN', '40'))
+AUTO_QUALITY_MAX = int(os.environ.get('AUTO_QUALITY_MAX', '95'))
+AUTO_QUALITY_TIME_BUDGET = float(os.environ.get('AUTO_QUALITY_TIME_BUDGET', '0.5'))
+
+# Default render backend: imagemagick or pillow. Customers can override it with render_backend in credentials.json.
+# Requests the Pillow backend doesn't support are rendered with ImageMagick.
+RENDER_BACKEND = os.environ.get('RENDER_BACKEND', 'imagemagick')
+
+# Clients allowed to scrape the /metrics endpoint
+METRICS_ALLOWED_IPS = os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+
+# Background reloading of credentials.json in multi customer mode
+CREDENTIALS_REFRESH_INTERVAL = int(os.environ.get('CREDENTIALS_REFRESH_INTERVAL', '300'))
+CREDENTIALS_REFRESH_JITTER = int(os.environ.get('CREDENTIALS_REFRESH_JITTER', '30'))
+
+# Format of the keys of rendered images: legacy, canonical or hashed
+DERIVATIVE_KEY_FORMAT = os.environ.get('DERIVATIVE_KEY_FORMAT', 'canonical')
+# Also look for images rendered under their legacy key before rendering them again
+DERIVATIVE_KEY_LEGACY_FALLBACK = os.environ.get('DERIVATIVE_KEY_LEGACY_FALLBACK', 'true').lower() == 'true'
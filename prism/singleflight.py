@@ -0,0 +1,110 @@
+import contextlib
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key so only one of them does the work.
+
+    Within a worker the first caller for a key (the leader) runs the function and the
+    other threads wait for its outcome. If `lock_dir` is given, leaders in different
+    processes on the same host also serialize on a lock file; a leader that had to wait
+    for another process calls `recheck` before doing the work itself. Keys are spread
+    over a fixed number of lock files so the directory never grows.
+    """
+
+    def __init__(self, lock_dir=None, timeout=30, lock_files=1024):
+        self.lock_dir = lock_dir
+        self.timeout = timeout
+        self.lock_files = lock_files
+        self._calls = {}
+        self._lock = threading.Lock()
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def do(self, key, fn, recheck=None):
+        """
+        Runs `fn()` once for all concurrent callers with the same key and returns its result
+        (or raises its exception) to all of them.
+
+        If `recheck()` returns True after waiting on another process, `fn` is skipped and None returned.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if call.done.wait(self.timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            # The leader is taking too long, don't wait any longer and do the work ourselves
+            logger.warning("Timed out waiting for %s", key)
+            return fn()
+
+        try:
+            with self._process_lock(key) as waited:
+                if waited and recheck is not None and recheck():
+                    call.result = None
+                else:
+                    call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    @contextlib.contextmanager
+    def _process_lock(self, key):
+        """
+        Holds an exclusive lock on the lock file for the key and yields whether we had to wait for it.
+        Gives up on the lock (but still yields) after the timeout.
+        """
+        if not self.lock_dir:
+            yield False
+            return
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        n = int.from_bytes(digest[:4], 'big') % self.lock_files
+        path = os.path.join(self.lock_dir, '%04d.lock' % n)
+        with open(path, 'a') as f:
+            waited = False
+            locked = False
+            deadline = time.monotonic() + self.timeout
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                    break
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                waited = True
+                if time.monotonic() > deadline:
+                    logger.warning("Timed out waiting for lock file %s", path)
+                    break
+                time.sleep(0.05)
+            try:
+                yield waited
+            finally:
+                if locked:
+                    fcntl.flock(f, fcntl.LOCK_UN)
@@ -1,15 +1,25 @@
 import os
 import json
+import tempfile
+import threading
+import time
 import unittest
 import urllib.parse
+from io import BytesIO
+from unittest import mock
 
-from werkzeug.test import EnvironBuilder
+from PIL import Image
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.exceptions import BadRequest
+from werkzeug.test import Client, EnvironBuilder
 from werkzeug.wrappers import Request
 
 from prism.app import get_dimensions, get_output_format, get_command, make_retina, convert_filters_to_json, get_opacity
-from prism.app import App, CredentialsStore, Customer
-from prism.core import upload_file, S3ConnectionConfig
-from prism import settings
+from prism.app import App, CredentialsStore, Customer, parse_batch_args, get_mimetype, get_original_info, process
+from prism.app import SingleCustomerCredentialsStore, info
+from prism.core import upload_file, S3ConnectionConfig, OriginalFileTooLargeError, OriginalTooLargeError
+from prism import metrics, settings
+from prism.cache import DiskCache, FrequencySketch
 
 
 def make_image_request(subdomain: str, path: str, query_args: dict) -> Request:
@@ -97,7 +107,7 @@ class TestGetDimensions(unittest.TestCase):
         self.assertRaises(Exception, get_dimensions, {'width': 200}, 'resize_then_crop')
         self.assertRaises(Exception, get_dimensions, {'height': 10001, 'width': 10001}, 'resize')
         self.assertEqual(get_dimensions({'height': 4001, 'width': 4001}, 'resize'), (4001, 4001))
-        self.assertRaises(Exception, get_dimensions, {'height': 4001, 'width': 4001, 'premultiplied': True}, 'resize')
+        self.assertEqual(get_dimensions({'height': 4001, 'width': 4001, 'premultiplied': True}, 'resize'), (4001, 4001))
         self.assertRaises(Exception, get_dimensions, {'height': '', 'width': ''}, 'resize')
 
 
@@ -119,8 +129,13 @@ class TestMakeRetina(unittest.TestCase):
 
 class TestConvertFiltersToJson(unittest.TestCase):
     def test_values(self):
-        self.assertEqual(convert_filters_to_json({'filters': '["foo", {"bar":["baz", null, 1.0, 2]}]'}), ["foo", {"bar": ["baz", None, 1.0, 2]}])
+        self.assertEqual(convert_filters_to_json({'filters': '[{"id": "translucent", "background_color": "#000", "opacity": 2.5}]'}),
+                         [{'id': 'translucent', 'background_color': '#000', 'opacity': 2.5}])
         self.assertRaises(Exception, convert_filters_to_json, {'filters': '["foo", "bar":["baz", null, 1.0, 2]}]'})
+        # unknown filters and invalid parameters are rejected with error 113 instead of failing the render
+        for filters in ('["foo", {"bar":["baz", null, 1.0, 2]}]', '[{"id": "translucent", "background_color": "zz"}]'):
+            with self.assertRaisesRegex(Exception, 'Error 113'):
+                convert_filters_to_json({'filters': filters})
 
 
 class TestGetOpacity(unittest.TestCase):
@@ -128,3 +143,247 @@ class TestGetOpacity(unittest.TestCase):
         self.assertEqual(get_opacity('resize', {'out': 'png'}), 100)
         self.assertEqual(get_opacity('resize', {'out': 'jpg'}), 0)
         self.assertEqual(get_opacity('resize_then_crop', {'out': 'png'}), 0)
+
+
+class TestParseBatchArgs(unittest.TestCase):
+    def test_values(self):
+        request = make_image_request('foo', 'image.jpg', {
+            'cmd': 'batch',
+            'variants': '[{"w": 100}, {"cmd": "resize_then_crop", "w": 200, "h": 200, "out": "png"}]',
+        })
+        variants = parse_batch_args('image.jpg', request)
+        self.assertEqual([v['command'] for v in variants], ['resize', 'resize_then_crop'])
+        self.assertEqual(variants[1]['options']['w'], 200)
+        self.assertEqual(variants[1]['options']['out_format'], 'png')
+
+    def test_invalid(self):
+        for variants in ('', '{}', '[]', '[1]', '[{"cmd": "batch"}]', '[{"h": 200, "cmd": "resize_then_crop"}]'):
+            request = make_image_request('foo', 'image.jpg', {'cmd': 'batch', 'variants': variants})
+            self.assertRaises(Exception, parse_batch_args, 'image.jpg', request)
+
+
+class TestGetMimetype(unittest.TestCase):
+    def test_values(self):
+        self.assertEqual(get_mimetype(b'\xff\xd8\xff\xe0', 'a.png'), 'image/jpeg')
+        self.assertEqual(get_mimetype(b'\x89PNG\r\n\x1a\n...', 'a.jpg'), 'image/png')
+        self.assertEqual(get_mimetype(b'RIFF\x00\x00\x00\x00WEBPVP8 ', 'a.jpg'), 'image/webp')
+        self.assertEqual(get_mimetype(b'unknown', 'a.jpg'), 'image/jpeg')
+
+
+class TestGetCustomer(unittest.TestCase):
+    def test_unknown_customer_label(self):
+        app = App(credentials_store=CredentialsStore(bucket='unused', default_customer='foo'))
+        app.credentials_store.customers = {'foo': Customer()}
+        app.credentials_store._refresher_pid = os.getpid()
+        metrics.start_request()
+        self.assertIsNotNone(app.get_customer(make_image_request('foo', 'a.jpg', {'customer': 'foo'})))
+        self.assertEqual(metrics.get_labels()['customer'], 'foo')
+        metrics.start_request()
+        self.assertRaises(KeyError, app.get_customer, make_image_request('bar', 'a.jpg', {'customer': 'bar'}))
+        self.assertEqual(metrics.get_labels()['customer'], '')
+        metrics.finish_request()
+
+    def test_single_customer_label(self):
+        app = App(credentials_store=SingleCustomerCredentialsStore({'read_bucket_name': 'originals'}))
+        metrics.start_request()
+        self.assertIsNotNone(app.get_customer(make_image_request('bar', 'a.jpg', {'customer': 'bar'})))
+        self.assertEqual(metrics.get_labels()['customer'], '')
+        metrics.finish_request()
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+    def get(self, remote_addr, headers=None):
+        app = ProxyFix(App(credentials_store=SingleCustomerCredentialsStore({'read_bucket_name': 'originals'})))
+        client = Client(app)
+        return client.get('/metrics', headers=headers, environ_base={'REMOTE_ADDR': remote_addr})
+
+    def test_allowed(self):
+        self.assertEqual(self.get('127.0.0.1').status_code, 200)
+
+    def test_forwarded_for_is_ignored(self):
+        self.assertEqual(self.get('203.0.113.7').status_code, 404)
+        self.assertEqual(self.get('203.0.113.7', headers={'X-Forwarded-For': '127.0.0.1'}).status_code, 404)
+
+
+class TestCredentialsStore(unittest.TestCase):
+    def store(self, *contents):
+        """
+        Returns a store whose credentials.json has the given contents on successive loads.
+        A content that is an exception is raised instead, and one that is a function is called.
+        """
+        contents = iter(contents)
+
+        def load():
+            content = next(contents)
+            if isinstance(content, Exception):
+                raise content
+            return content() if callable(content) else content
+
+        key = mock.Mock()
+        key.get_contents_as_string.side_effect = load
+        for patcher in (mock.patch('prism.app.Key', return_value=key), mock.patch('prism.core.get_s3_client')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        store = CredentialsStore(bucket='secrets', default_customer='foo')
+        # no background refresher, the tests refresh explicitly
+        store._refresher_pid = os.getpid()
+        return store
+
+    def credentials(self, **customers):
+        return json.dumps({name: {'read_bucket_name': bucket} for name, bucket in customers.items()})
+
+    def test_failed_refresh_keeps_customers(self):
+        store = self.store(self.credentials(foo='a'), ValueError('S3 is down'), 'not json')
+        self.assertEqual(store.get_customer('foo').read_bucket_name, 'a')
+        loaded_at = store.loaded_at
+        store.refresh()
+        store.refresh()
+        self.assertEqual(store.get_customer('foo').read_bucket_name, 'a')
+        self.assertEqual((store.refresh_failures, store.loaded_at), (2, loaded_at))
+
+    def test_swap(self):
+        store = self.store(self.credentials(foo='a', bar='b'), self.credentials(foo='c'))
+        customers = store._get_customers()
+        store.refresh()
+        # the customers are replaced, not updated in place, so readers see either all old or all new ones
+        self.assertEqual({k: c.read_bucket_name for k, c in customers.items()}, {'foo': 'a', 'bar': 'b'})
+        self.assertEqual({k: c.read_bucket_name for k, c in store.customers.items()}, {'foo': 'c'})
+        self.assertRaises(KeyError, store.get_customer, 'bar')
+
+    def test_lookup_does_not_wait_for_refresh(self):
+        loading = threading.Event()
+        release = threading.Event()
+
+        def slow_load():
+            loading.set()
+            release.wait(5)
+            return self.credentials(foo='b')
+
+        store = self.store(self.credentials(foo='a'), slow_load)
+        store.get_customer('foo')
+        store._refresher_pid = None
+        with mock.patch.object(CredentialsStore, '_refresh_forever', lambda self: self.refresh()):
+            start = time.monotonic()
+            # starts the refresher, which blocks while loading
+            self.assertEqual(store.get_customer('foo').read_bucket_name, 'a')
+            self.assertTrue(loading.wait(5))
+            self.assertEqual(store.get_customer('foo').read_bucket_name, 'a')
+            self.assertLess(time.monotonic() - start, 1)
+        release.set()
+        deadline = time.monotonic() + 5
+        while store.get_customer('foo').read_bucket_name != 'b' and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(store.get_customer('foo').read_bucket_name, 'b')
+
+    def test_refresher_survives(self):
+        class Stop(BaseException):
+            pass
+
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 5:
+                raise Stop
+
+        store = CredentialsStore(bucket='secrets', default_customer='foo', refresh_interval=20, refresh_jitter=30)
+        with mock.patch('prism.app.time.sleep', sleep), \
+                mock.patch('prism.app.random.uniform', return_value=-30), \
+                mock.patch.object(store, 'refresh', side_effect=[RuntimeError('boom'), None, None]) as refresh:
+            self.assertRaises(Stop, store._refresh_forever)
+        # an interval shorter than the jitter and an exception don't end the loop
+        self.assertTrue(all(seconds >= 0 for seconds in sleeps))
+        self.assertEqual(refresh.call_count, 3)
+
+
+class TestGetOriginalInfo(unittest.TestCase):
+    def test_values(self):
+        f = BytesIO()
+        Image.new('RGB', (400, 300)).save(f, 'JPEG')
+        with mock.patch('prism.core.info') as info:
+            # not from the image, which may have been decoded at a reduced scale
+            self.assertEqual(get_original_info(f.getvalue(), im=mock.Mock())['width'], 400)
+            info.assert_not_called()
+            f = BytesIO()
+            Image.new('RGB', (400, 300)).save(f, 'TIFF')
+            self.assertIsNone(get_original_info(f.getvalue()))
+            self.assertIs(get_original_info(f.getvalue(), im=mock.Mock()), info.return_value)
+
+
+class TestInfo(unittest.TestCase):
+    def test_too_large(self):
+        customer = Customer(read_bucket_name='originals', read_bucket_region='us-east-1')
+        for error in (OriginalTooLargeError, OriginalFileTooLargeError):
+            with mock.patch('prism.core.fetch_info', side_effect=error):
+                self.assertRaises(BadRequest, info, 'a.tif', {}, customer)
+
+
+class TestHotCache(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.find_existing_result = mock.Mock(side_effect=lambda path, cmd, options, customer, url: url)
+        self.download_result = mock.Mock(return_value=b'\xff\xd8\xffjpeg')
+        self.render_flight = mock.Mock()
+        self.render_flight.do.return_value = None
+        for patcher in (mock.patch('prism.core.hot_cache', DiskCache(directory.name, max_bytes=10000)),
+                        mock.patch('prism.core.hot_requests', FrequencySketch(width=1024)),
+                        mock.patch('prism.core.download_result', self.download_result),
+                        mock.patch('prism.app.find_existing_result', self.find_existing_result),
+                        mock.patch('prism.app.render_flight', self.render_flight),
+                        mock.patch('prism.settings.HOT_CACHE_MIN_REQUESTS', 2),
+                        mock.patch('prism.settings.HOT_CACHE_TTL', 60)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.customer = Customer(read_bucket_name='originals', write_bucket_name='derivatives',
+                                 read_bucket_region='us-east-1', write_bucket_region='us-east-1')
+
+    def process(self, force=False):
+        args = {
+            'command': 'resize', 'debug': False, 'with_info': False, 'force': force, 'no_redirect': False,
+            'options': {
+                'w': 100, 'h': None, 'q': 90, 'crop_x': None, 'crop_y': None, 'crop_width': None, 'crop_height': None,
+                'frame_bg_color': 'FFF', 'gravity': 'center', 'preserve_ratio': True, 'premultiplied_alpha': None,
+                'filters': None, 'out_format': 'jpg', 'opacity': 0,
+            },
+        }
+        return process('a.jpg', args, self.customer)
+
+    def cached_files(self):
+        return sum(len(files) for _, _, files in os.walk(self.directory))
+
+    def test_hit(self):
+        self.assertEqual(self.process().status_code, 302)
+        self.download_result.assert_not_called()
+        # admitted on its second request
+        r = self.process()
+        self.assertEqual((r.status_code, r.get_data(), r.mimetype), (200, b'\xff\xd8\xffjpeg', 'image/jpeg'))
+        self.assertEqual(self.process().get_data(), b'\xff\xd8\xffjpeg')
+        self.assertEqual((self.find_existing_result.call_count, self.download_result.call_count), (2, 1))
+
+    def test_expiry(self):
+        self.process()
+        self.process()
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertEqual(self.process().status_code, 200)
+        self.assertEqual((self.find_existing_result.call_count, self.download_result.call_count), (3, 2))
+
+    def test_force(self):
+        self.process()
+        self.process()
+        self.assertEqual(self.cached_files(), 1)
+        self.process(force=True)
+        self.render_flight.do.assert_called_once()
+        self.assertEqual(self.cached_files(), 0)
+
+    def test_too_large(self):
+        self.download_result.return_value = None
+        self.process()
+        r = self.process()
+        self.assertEqual(r.status_code, 302)
+        # the url is cached, so the derivative is redirected to without checking S3
+        r = self.process()
+        self.assertEqual(r.status_code, 302)
+        self.assertIn('derivatives', r.headers['Location'])
+        self.assertEqual((self.find_existing_result.call_count, self.download_result.call_count), (2, 1))
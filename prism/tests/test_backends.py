@@ -0,0 +1,103 @@
+import unittest
+from io import BytesIO
+from unittest import mock
+
+from PIL import Image, ImageSequence, PngImagePlugin
+
+import prism.core as core
+
+from prism.backends import AnimatedGifBackend, PillowBackend, UnsupportedGifOptionsError, make_color, plan, render
+
+
+class TestPillowBackend(unittest.TestCase):
+    def options(self, **kwargs):
+        options = {
+            'w': 200, 'h': 100, 'q': 90, 'crop_x': None, 'crop_y': None, 'crop_width': None, 'crop_height': None,
+            'frame_bg_color': 'FFF', 'gravity': 'center', 'preserve_ratio': True, 'premultiplied_alpha': None,
+            'filters': None, 'out_format': 'jpg', 'opacity': 0,
+        }
+        options.update(kwargs)
+        return options
+
+    def original(self, size, fmt='JPEG', mode='RGB'):
+        f = BytesIO()
+        Image.new(mode, size, 'red').save(f, fmt)
+        return f.getvalue()
+
+    def test_supports(self):
+        backend = PillowBackend()
+        self.assertTrue(backend.supports('resize', self.options()))
+        self.assertFalse(backend.supports('resize', self.options(out_format='png')))
+        self.assertFalse(backend.supports('resize', self.options(filters=[{'id': 'translucent'}])))
+        self.assertFalse(backend.supports('resize', self.options(crop_x='10', crop_y='10', crop_width='50', crop_height='50')))
+        self.assertFalse(backend.supports('resize_then_crop', self.options(gravity='smart')))
+
+    def test_plan(self):
+        self.assertEqual(plan(1300, 944, 'resize', self.options(w=400, h=200)), ((275, 200), None, True, None))
+        self.assertEqual(plan(1300, 944, 'resize', self.options(w=400, h=None)), ((400, 290), None, False, None))
+        self.assertEqual(plan(1300, 944, 'resize_then_crop', self.options(w=400, h=400)),
+                         ((551, 400), (75, 0, 475, 400), False, None))
+        self.assertEqual(plan(1300, 944, 'resize_then_crop', self.options(w=400, h=400, gravity='top_left')),
+                         ((551, 400), (0, 0, 400, 400), False, None))
+        self.assertEqual(plan(1300, 944, 'resize_then_fit', self.options(w=400, h=400)),
+                         ((400, 290), None, True, (400, 400)))
+
+    def test_make_color(self):
+        self.assertEqual(make_color('#FFF', 0), (255, 255, 255, 255))
+        self.assertEqual(make_color('102030', 100), (16, 32, 48, 0))
+
+    def test_render(self):
+        backend = PillowBackend()
+        f = backend.render(self.original((1300, 944)), 'resize_then_crop', self.options(w=400, h=400))
+        self.assertEqual(Image.open(f).size, (400, 400))
+        f = backend.render(self.original((1300, 944), 'PNG', 'RGBA'), 'resize_then_fit', self.options(out_format='webp'))
+        image = Image.open(f)
+        self.assertEqual((image.format, image.size), ('WEBP', (200, 100)))
+
+    def test_pixel_budget_before_loading(self):
+        original = self.original((300, 200), 'PNG')
+        with mock.patch('prism.settings.MAX_ORIGINAL_PIXELS', 50000), \
+                mock.patch.object(PngImagePlugin.PngImageFile, 'load', side_effect=AssertionError('loaded')):
+            self.assertRaises(core.OriginalTooLargeError, PillowBackend().render, original, 'resize', self.options())
+
+
+class TestAnimatedGifBackend(unittest.TestCase):
+    def options(self, **kwargs):
+        options = {
+            'w': 150, 'h': None, 'q': 80, 'crop_x': None, 'crop_y': None, 'crop_width': None, 'crop_height': None,
+            'frame_bg_color': 'FFF', 'gravity': 'center', 'preserve_ratio': True, 'premultiplied_alpha': None,
+            'filters': None, 'out_format': 'webp', 'opacity': 100,
+        }
+        options.update(kwargs)
+        return options
+
+    def test_render(self):
+        frames = [Image.new('RGB', (300, 200), color) for color in ('red', 'green', 'blue')]
+        f = BytesIO()
+        frames[0].save(f, 'GIF', save_all=True, append_images=frames[1:], duration=[50, 10, 50], loop=0)
+        image = Image.open(AnimatedGifBackend().render(f.getvalue(), 'resize', self.options()))
+        self.assertEqual((image.format, image.size, image.n_frames), ('WEBP', (150, 100), 3))
+        durations = []
+        for frame in ImageSequence.Iterator(image):
+            frame.load()
+            durations.append(frame.info['duration'])
+        self.assertEqual(durations, [50, 100, 50])
+        self.assertEqual(image.info['loop'], 0)
+
+    def test_loop_once(self):
+        frames = [Image.new('RGB', (30, 20), color) for color in ('red', 'green')]
+        f = BytesIO()
+        frames[0].save(f, 'GIF', save_all=True, append_images=frames[1:], duration=50)
+        self.assertNotIn('loop', Image.open(f).info)
+        image = Image.open(AnimatedGifBackend().render(f.getvalue(), 'resize', self.options(w=15)))
+        self.assertEqual(image.info['loop'], 1)
+
+    def test_unsupported_options(self):
+        f = BytesIO()
+        Image.new('RGB', (30, 20)).save(f, 'GIF')
+        with mock.patch('prism.settings.RESIZE_GIFS', True), \
+                mock.patch('prism.backends.imagemagick.render') as imagemagick_render:
+            for options in (self.options(filters=[{'id': 'unsharp_mask'}]), self.options(crop_width=10),
+                            self.options(gravity='smart'), self.options(premultiplied_alpha=True)):
+                self.assertRaises(UnsupportedGifOptionsError, render, f.getvalue(), 'resize', options)
+            imagemagick_render.assert_not_called()
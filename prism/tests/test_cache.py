@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from prism.cache import DiskCache, ExistenceCache, FrequencySketch
+
+
+class TestExistenceCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = ExistenceCache(max_size=10, ttl=60, negative_ttl=5)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', True)
+        cache.set('b', False)
+        self.assertTrue(cache.get('a'))
+        self.assertFalse(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_expiry(self):
+        cache = ExistenceCache(max_size=10, ttl=60, negative_ttl=5)
+        with mock.patch('time.monotonic', return_value=100):
+            cache.set('a', True)
+            cache.set('b', False)
+        with mock.patch('time.monotonic', return_value=110):
+            self.assertTrue(cache.get('a'))
+            self.assertIsNone(cache.get('b'))
+        with mock.patch('time.monotonic', return_value=200):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_max_size(self):
+        cache = ExistenceCache(max_size=2)
+        cache.set('a', True)
+        cache.set('b', True)
+        cache.get('a')
+        cache.set('c', True)
+        self.assertIsNone(cache.get('b'))
+        self.assertTrue(cache.get('a'))
+        self.assertTrue(cache.get('c'))
+
+    def test_disabled(self):
+        cache = ExistenceCache(max_size=0)
+        cache.set('a', True)
+        self.assertIsNone(cache.get('a'))
+
+
+class TestDiskCache(unittest.TestCase):
+    def test_get_put(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskCache(directory, max_bytes=1000)
+            self.assertIsNone(cache.get('a'))
+            cache.put('a', b'data', {'etag': '"123"'})
+            self.assertEqual(cache.get('a'), ({'etag': '"123"'}, b'data'))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            cache.discard('a')
+            self.assertIsNone(cache.get('a'))
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskCache(directory, max_bytes=1000)
+            cache.put('a', b'a' * 400)
+            os.utime(cache._path('a'), (0, 0))
+            cache.put('b', b'b' * 400)
+            cache.put('c', b'c' * 400)
+            self.assertIsNone(cache.get('a'))
+            self.assertIsNotNone(cache.get('b'))
+            self.assertIsNotNone(cache.get('c'))
+
+
+class TestFrequencySketch(unittest.TestCase):
+    def test_increment(self):
+        sketch = FrequencySketch(width=1024)
+        self.assertEqual([sketch.increment('a') for _ in range(3)], [1, 2, 3])
+        self.assertEqual(sketch.frequency('a'), 3)
+        self.assertEqual(sketch.frequency('b'), 0)
+
+    def test_saturation(self):
+        sketch = FrequencySketch(width=1024, sample_size=10000)
+        for _ in range(300):
+            sketch.increment('a')
+        self.assertEqual(sketch.frequency('a'), 255)
+
+    def test_aging(self):
+        sketch = FrequencySketch(width=1024, sample_size=100)
+        for _ in range(40):
+            sketch.increment('a')
+        for i in range(60):
+            sketch.increment(str(i))
+        self.assertEqual(sketch.frequency('a'), 20)
@@ -0,0 +1,224 @@
+import http.server
+import os
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from io import BytesIO
+from unittest import mock
+
+import requests
+from PIL import Image
+
+from prism.core import S3ConnectionConfig, get_cached_s3_client, clear_s3_client_cache, get_decode_size_hint
+from prism.core import get_thumb_filename, header_info, make_result_info, read_body, OriginalFileTooLargeError
+from prism.core import UnsupportedHeaderError, download_original, fetch_info
+from prism.cache import DiskCache
+
+
+class TestCachedS3Client(unittest.TestCase):
+    def test_reuse(self):
+        config = S3ConnectionConfig(key_id='foo', secret_key='bar', region='us-east-1', endpoint_url=None)
+        conn = get_cached_s3_client(config)
+        self.assertIs(get_cached_s3_client(S3ConnectionConfig(key_id='foo', secret_key='bar', region='us-east-1', endpoint_url=None)), conn)
+        self.assertIsNot(get_cached_s3_client(S3ConnectionConfig(key_id='baz', secret_key='bar', region='us-east-1', endpoint_url=None)), conn)
+
+    def test_clear(self):
+        config = S3ConnectionConfig(key_id='foo', secret_key='bar', region='us-east-1', endpoint_url=None)
+        conn = get_cached_s3_client(config)
+        clear_s3_client_cache()
+        self.assertIsNot(get_cached_s3_client(config), conn)
+
+
+class TestGetDecodeSizeHint(unittest.TestCase):
+    def options(self, **kwargs):
+        options = {'w': None, 'h': None, 'crop_x': None, 'crop_y': None, 'crop_width': None, 'crop_height': None, 'filters': None}
+        options.update(kwargs)
+        return options
+
+    def test_values(self):
+        self.assertEqual(get_decode_size_hint('resize', self.options(w=200)), (400, 400))
+        self.assertEqual(get_decode_size_hint('resize_then_crop', self.options(w=200, h=300)), (600, 600))
+        self.assertIsNone(get_decode_size_hint('resize', self.options(w=200, h=200, crop_x='10', crop_y='10', crop_width='100', crop_height='100')))
+        self.assertIsNone(get_decode_size_hint('resize', self.options(w=200, filters=[{'id': 'translucent'}])))
+        self.assertIsNone(get_decode_size_hint('info', self.options()))
+
+
+class TestGetThumbFilename(unittest.TestCase):
+    def options(self, **kwargs):
+        options = {
+            'w': 200, 'h': 100, 'q': 95, 'crop_x': None, 'crop_y': None, 'crop_width': None, 'crop_height': None,
+            'frame_bg_color': 'FFF', 'gravity': 'center', 'preserve_ratio': True, 'premultiplied_alpha': None,
+            'filters': None, 'out_format': 'jpg',
+        }
+        options.update(kwargs)
+        return options
+
+    def test_legacy_compatible(self):
+        for cmd, options in (('resize', self.options()),
+                             ('resize', self.options(frame_bg_color='000', q=80)),
+                             ('resize', self.options(preserve_ratio=False)),
+                             ('resize_then_crop', self.options(gravity='top_left')),
+                             ('resize', self.options(crop_x='10', crop_y='20', crop_width='300', crop_height='400'))):
+            self.assertEqual(get_thumb_filename('a.jpg', cmd, options, key_format='canonical'),
+                             get_thumb_filename('a.jpg', cmd, options, key_format='legacy'))
+        self.assertEqual(get_thumb_filename('a.jpg', 'resize', self.options(), key_format='legacy'),
+                         'prism-images/a.jpg--resize--w__200--h__100.jpg')
+
+    def test_equivalent_options(self):
+        def key(cmd, **kwargs):
+            return get_thumb_filename('a.jpg', cmd, self.options(**kwargs), key_format='canonical')
+
+        self.assertEqual(key('resize', frame_bg_color='fff'), key('resize'))
+        self.assertEqual(key('resize', frame_bg_color='#ffffff'), key('resize'))
+        self.assertEqual(key('resize_then_crop', frame_bg_color='000', preserve_ratio=False), key('resize_then_crop'))
+        self.assertEqual(key('resize', gravity='top_left'), key('resize'))
+        self.assertEqual(key('resize', preserve_ratio=False, frame_bg_color='000'), key('resize', preserve_ratio=False))
+        self.assertEqual(key('resize', crop_x='010', crop_y='20', crop_width='300', crop_height='400'),
+                         key('resize', crop_x='10', crop_y='20', crop_width='300', crop_height='400'))
+        self.assertEqual(key('resize', premultiplied_alpha='true'), key('resize', premultiplied_alpha='1'))
+        self.assertEqual(key('resize', filters=[{'id': 'translucent', 'opacity': 20}]),
+                         key('resize', filters=[{'opacity': 20, 'id': 'translucent'}]))
+        self.assertNotEqual(key('resize', frame_bg_color='000'), key('resize'))
+
+    def test_hashed(self):
+        key = get_thumb_filename('a.jpg', 'resize', self.options(), key_format='hashed')
+        self.assertRegex(key, r'^prism-images/a.jpg--resize--[0-9a-f]{16}.jpg$')
+
+
+class TestHeaderInfo(unittest.TestCase):
+    def test_jpeg(self):
+        image = Image.new('RGB', (400, 300))
+        exif = image.getexif()
+        exif[0x0112] = 6
+        exif[0x010f] = 'Canon'
+        f = BytesIO()
+        image.save(f, 'JPEG', exif=exif.tobytes(), icc_profile=b'0' * 5000)
+        data = f.getvalue()
+        self.assertIsNone(header_info(data[:3000]))
+        self.assertEqual(header_info(data[:6000]), {
+            'img_type': 'truecolor', 'alpha_channel': False, 'width': 300, 'height': 400,
+            'exif': {'exif:Orientation': '6', 'exif:Make': 'Canon'},
+        })
+
+    def test_png(self):
+        f = BytesIO()
+        Image.new('RGBA', (10, 20)).save(f, 'PNG')
+        info = header_info(f.getvalue()[:100])
+        self.assertEqual((info['img_type'], info['alpha_channel'], info['width'], info['height']), ('truecoloralpha', True, 10, 20))
+
+    def test_truncated_png(self):
+        # noise doesn't compress, so the pixels are well past the first 64KB
+        image = Image.frombytes('RGB', (400, 300), os.urandom(400 * 300 * 3))
+        f = BytesIO()
+        image.save(f, 'PNG')
+        self.assertGreater(len(f.getvalue()), 65536)
+        self.assertEqual(header_info(f.getvalue()[:65536]), {
+            'img_type': 'truecolor', 'alpha_channel': False, 'width': 400, 'height': 300, 'exif': {},
+        })
+        exif = image.getexif()
+        exif[0x0112] = 6
+        f = BytesIO()
+        image.save(f, 'PNG', exif=exif.tobytes())
+        info = header_info(f.getvalue()[:65536])
+        self.assertEqual((info['width'], info['height'], info['exif']), (300, 400, {'exif:Orientation': '6'}))
+
+    def test_unsupported(self):
+        f = BytesIO()
+        Image.new('RGB', (10, 20)).save(f, 'TIFF')
+        self.assertRaises(UnsupportedHeaderError, header_info, f.getvalue())
+        self.assertRaises(UnsupportedHeaderError, header_info, f.getvalue()[:100])
+
+
+class TestFetchInfo(unittest.TestCase):
+    def test_unsupported_format(self):
+        f = BytesIO()
+        Image.new('RGB', (400, 300)).save(f, 'TIFF')
+        session = mock.Mock()
+        session.get.return_value = mock.Mock(status_code=206, content=f.getvalue()[:65536])
+        with mock.patch('prism.settings.INFO_RANGE_BYTES', 65536), \
+                mock.patch('prism.core.get_http_session', return_value=session), \
+                mock.patch('prism.core.fetch_image') as fetch_image, mock.patch('prism.core.info') as info:
+            self.assertIs(fetch_info('https://bucket/a.tif'), info.return_value)
+        # the full image is downloaded without first trying larger ranges
+        self.assertEqual(session.get.call_count, 1)
+        info.assert_called_once_with(fetch_image.return_value)
+
+
+class TestDownloadOriginal(unittest.TestCase):
+    def test_etag(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        body = b'\xff\xd8\xffjpeg'
+        ok = mock.MagicMock(status_code=200, headers={'content-length': str(len(body)), 'etag': '"abc"'})
+        ok.__enter__.return_value = ok
+        ok.raw.read.return_value = body
+        not_modified = mock.MagicMock(status_code=304, headers={})
+        not_modified.__enter__.return_value = not_modified
+        session = mock.Mock()
+        session.get.side_effect = [ok, not_modified]
+        with mock.patch('prism.core.originals_cache', DiskCache(directory.name, max_bytes=10000)), \
+                mock.patch('prism.core.get_http_session', return_value=session):
+            self.assertEqual(download_original('https://bucket/a.jpg'), (body, '"abc"'))
+            # revalidated from the cache, with the ETag stored with it
+            self.assertEqual(download_original('https://bucket/a.jpg'), (body, '"abc"'))
+        self.assertEqual(session.get.call_args[1]['headers'], {'If-None-Match': '"abc"'})
+
+
+class TestMakeResultInfo(unittest.TestCase):
+    def test_values(self):
+        f = BytesIO()
+        Image.new('RGB', (40, 30)).save(f, 'PNG')
+        info = make_result_info('"919c8b643b7133116b02fc0d9bb7df3f"', f.getvalue(), {'width': 400, 'height': 300})
+        self.assertEqual(info, {
+            'width': 40, 'height': 30, 'format': 'png', 'size': len(f.getvalue()),
+            'source_etag': '919c8b643b7133116b02fc0d9bb7df3f', 'original': {'width': 400, 'height': 300},
+        })
+
+
+class TestReadBody(unittest.TestCase):
+    class Response(object):
+        def __init__(self, body, content_length=None):
+            self.body = body
+            self.headers = {'content-length': content_length} if content_length else {}
+
+        def iter_content(self, chunk_size):
+            return (self.body[i:i + chunk_size] for i in range(0, len(self.body), chunk_size))
+
+    def test_read(self):
+        body = bytes(range(256)) * 1000
+        self.assertEqual(read_body(self.Response(body)), body)
+        self.assertEqual(read_body(self.Response(body), max_bytes=len(body)), body)
+
+    def test_too_large(self):
+        body = b'0' * 100000
+        with self.assertRaises(OriginalFileTooLargeError):
+            read_body(self.Response(body, content_length=str(len(body))), max_bytes=1000)
+        with self.assertRaises(OriginalFileTooLargeError):
+            read_body(self.Response(body), max_bytes=1000)
+
+    def test_single_copy(self):
+        body = os.urandom(8 * 1024 * 1024)
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        self.addCleanup(server.server_close)
+        threading.Thread(target=server.handle_request, daemon=True).start()
+        with requests.get('http://127.0.0.1:%s/' % server.server_port, stream=True) as r:
+            tracemalloc.start()
+            try:
+                content = read_body(r, max_bytes=len(body))
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        self.assertEqual(content, body)
+        self.assertLess(peak, len(body) * 1.5)
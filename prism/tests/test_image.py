@@ -0,0 +1,143 @@
+import unittest
+from io import BytesIO
+
+import numpy
+from PIL import Image as Img
+from wand.image import Image
+
+from prism.image import ImageOperator, plan_filters, plan_resize, premultiply_alpha, validate_filters
+
+
+class TestPremultiplyAlpha(unittest.TestCase):
+    def test_values(self):
+        pixels = numpy.array([[[255, 128, 0, 255], [255, 128, 10, 128], [200, 100, 50, 0]]], dtype=numpy.uint8)
+        premultiply_alpha(pixels)
+        self.assertEqual(pixels.tolist(), [[[255, 128, 0, 255], [128, 64, 5, 128], [0, 0, 0, 0]]])
+
+    def test_chunks(self):
+        pixels = numpy.random.randint(0, 256, (100, 10, 4)).astype(numpy.uint8)
+        expected = pixels.copy()
+        premultiply_alpha(expected)
+        premultiply_alpha(pixels, chunk_rows=7)
+        self.assertTrue((pixels == expected).all())
+
+
+class TestPlanResize(unittest.TestCase):
+    def test_geometry(self):
+        self.assertEqual(plan_resize(1300, 944, (400, None)), [('transform', '', '400x')])
+        self.assertEqual(plan_resize(1300, 944, (None, 200)), [('transform', '', 'x200')])
+        self.assertEqual(plan_resize(1300, 944, (400, 200), preserve_ratio=False), [('transform', '', '400!x400!')])
+        self.assertEqual(plan_resize(1300, 944, (400, 200), crop_x='10', crop_y='20', crop_width='300', crop_height='400'),
+                         [('transform', '300x400+10+20', '400x200')])
+
+    def test_preserve_ratio(self):
+        self.assertEqual(plan_resize(1300, 944, (400, 200), frame_bg_color='000', opacity=0),
+                         [('transform', '', '400x200'), ('background', '#000', 0)])
+
+    def test_resize_then_crop(self):
+        # downscaling scales by the side that covers the wanted size, then crops
+        self.assertEqual(plan_resize(1300, 944, (400, 400), resize_then_crop=True, gravity='center'),
+                         [('transform', '', '551x400'), ('crop', 400, 400, 'center')])
+        # upscaling
+        self.assertEqual(plan_resize(590, 393, (720, 400), resize_then_crop=True),
+                         [('transform', '', '720x'), ('crop', 720, 400, 'top_left')])
+        self.assertEqual(plan_resize(1300, 944, (400, 400), resize_then_crop=True, gravity='smart'),
+                         [('transform', '', '551x400'), ('crop', 400, 400, 'smart')])
+
+    def test_resize_then_fit(self):
+        self.assertEqual(plan_resize(1300, 944, (400, 400), resize_then_fit=True),
+                         [('transform', '', '400x400'), ('background', '#FFF', 100), ('fit_frame', '#FFF', 400, 400, 100)])
+
+
+class TestFilters(unittest.TestCase):
+    def test_validate(self):
+        validate_filters([{'id': 'translucent', 'background_color': '000', 'opacity': 20, 'composite-width': 100}])
+        validate_filters([{'id': 'unsharp_mask'}])
+        validate_filters([{'id': 'translucent', 'background_color': '000', 'composite_width': None, 'sigma': 2.5}])
+        for filters in ({'id': 'translucent'},
+                        [{'id': 'sepia'}],
+                        [{'id': 'translucent'}],
+                        [{'id': 'translucent', 'background_color': '000', 'blur': 2}],
+                        [{'id': 'translucent', 'background_color': '000', 'opacity': '20'}],
+                        [{'id': 'translucent', 'background_color': 'zz'}],
+                        [{'id': 'translucent', 'background_color': '#00000080'}],
+                        [{'id': 'translucent', 'background_color': '000', 'opacity': None}],
+                        [{'id': 'translucent', 'background_color': '000', 'composite_x': None}],
+                        [{'id': 'unsharp_mask', 'sigma': None}],
+                        [{'id': 'translucent', 'background_color': '000', 'composite_width': 10.5}],
+                        [{'id': 'translucent', 'background_color': '000', 'composite_width': True}],
+                        [{'id': 'translucent', 'background_color': '000', 'opacity': -1}],
+                        [{'id': 'translucent', 'background_color': '000', 'opacity': 101}],
+                        [{'id': 'translucent', 'background_color': '000', 'radius': float('nan')}],
+                        [{'id': 'translucent', 'background_color': '000', 'sigma': 1000}],
+                        [{'id': 'translucent', 'background_color': '000',
+                          'composite_width': 1000000, 'composite_height': 1000000}],
+                        [{'id': 'unsharp_mask', 'threshold': 2}]):
+            with self.assertRaises(ValueError):
+                validate_filters(filters)
+
+    def test_plan(self):
+        self.assertEqual(plan_filters([{'id': 'translucent', 'background_color': '000', 'composite-x': 10},
+                                       {'id': 'unsharp_mask', 'radius': 2}]),
+                         [('translucent', {'background_color': '000', 'composite_x': 10}),
+                          ('unsharp_mask', {'radius': 2})])
+
+    def test_fuse_translucent(self):
+        (filter_id, params), = plan_filters([
+            {'id': 'translucent', 'background_color': 'FFF', 'opacity': 50, 'sigma': 6, 'radius': 6},
+            {'id': 'translucent', 'background_color': '000', 'opacity': 50, 'sigma': 8, 'radius': 8},
+        ])
+        self.assertEqual(filter_id, 'translucent')
+        # white at 50% and then black at 50% leaves 25% of the image, 25% white and 50% black
+        self.assertEqual(params['background_color'], '#555555')
+        self.assertAlmostEqual(params['opacity'], 25)
+        self.assertEqual((params['radius'], params['sigma']), (14, 10))
+
+
+class TestBackgroundPixels(unittest.TestCase):
+    """
+    set_background and fit_frame render the same pixels as compositing onto a cover image did.
+    """
+
+    def translucent(self):
+        # a gradient with alpha going from transparent to opaque
+        x = numpy.linspace(0, 255, 60).astype(numpy.uint8)
+        pixels = numpy.zeros((40, 60, 4), dtype=numpy.uint8)
+        pixels[..., 0] = x
+        pixels[..., 1] = 255 - x
+        pixels[..., 2] = 128
+        pixels[..., 3] = x
+        f = BytesIO()
+        Img.fromarray(pixels, 'RGBA').save(f, 'PNG')
+        return ImageOperator(Image(blob=f.getvalue()))
+
+    def composite(self, imop, color, opacity, width, height):
+        # the previous implementation
+        cover = Image(width=width, height=height, background=imop.make_color(color, opacity))
+        cover.composite(imop.image, int((width - imop.image.width) / 2), int((height - imop.image.height) / 2))
+        return cover
+
+    def assertSamePixels(self, image, expected):
+        def pixels(img):
+            return numpy.asarray(Img.open(BytesIO(img.make_blob('png'))).convert('RGBA')).astype(int)
+
+        a, b = pixels(image), pixels(expected)
+        self.assertEqual(a.shape, b.shape)
+        # transparent pixels have no visible color
+        a[a[..., 3] == 0] = 0
+        b[b[..., 3] == 0] = 0
+        self.assertLessEqual(numpy.abs(a - b).max(), 2)
+
+    def test_set_background(self):
+        for color, opacity in (('#FFF', 0), ('#102030', 0), ('#FFF', 50), ('#000', 100)):
+            imop = self.translucent()
+            expected = self.composite(imop, color, opacity, imop.image.width, imop.image.height)
+            imop.set_background(color, opacity)
+            self.assertSamePixels(imop.image, expected)
+
+    def test_fit_frame(self):
+        for color, opacity in (('#FFF', 0), ('#102030', 50), ('#000', 100)):
+            imop = self.translucent()
+            expected = self.composite(imop, color, opacity, 100, 70)
+            imop.fit_frame(color, 100, 70, opacity=opacity)
+            self.assertSamePixels(imop.image, expected)
@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from prism.janitor import TempDirJanitor
+
+
+class TestTempDirJanitor(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_dir)
+        self.janitor = TempDirJanitor(self.base_dir, max_age=300, interval=3600)
+        self.addCleanup(os.environ.pop, 'MAGICK_TEMPORARY_PATH', None)
+        self.janitor.start()
+
+    def write(self, path, size, age=0):
+        with open(path, 'wb') as f:
+            f.write(b'0' * size)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def test_start(self):
+        self.assertEqual(os.environ['MAGICK_TEMPORARY_PATH'], os.path.join(self.base_dir, str(os.getpid())))
+        self.assertTrue(os.path.isdir(self.janitor.path))
+
+    def test_sweep(self):
+        self.write(os.path.join(self.janitor.path, 'magick-new'), 10)
+        self.write(os.path.join(self.janitor.path, 'magick-old'), 20, age=600)
+        self.janitor.sweep()
+        self.assertEqual(os.listdir(self.janitor.path), ['magick-new'])
+        self.assertEqual((self.janitor.files, self.janitor.bytes, self.janitor.removed_files), (1, 10, 1))
+
+    def test_dead_workers(self):
+        # pids never exceed 2 ** 22 on linux
+        dead = os.path.join(self.base_dir, str(2 ** 22 + 1))
+        os.mkdir(dead)
+        self.write(os.path.join(dead, 'magick-orphan'), 10)
+        self.janitor.sweep()
+        self.assertEqual(os.listdir(self.base_dir), [str(os.getpid())])
+        self.assertEqual(self.janitor.removed_dirs, 1)
@@ -0,0 +1,27 @@
+import unittest
+
+from prism import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_request_timings(self):
+        metrics.start_request()
+        metrics.set_labels(customer='foo', command='resize')
+        metrics.observe('head', 0.002)
+        metrics.observe('get', 0.03)
+        metrics.observe('get', 0.01)
+        timings = metrics.finish_request()
+        self.assertEqual([stage for stage, _ in timings], ['head', 'get', 'get', 'total'])
+        self.assertEqual(metrics.server_timing_header(timings[:3]), 'head;dur=2.0, get;dur=40.0')
+        self.assertEqual(metrics.finish_request(), [])
+
+    def test_prometheus(self):
+        metrics.start_request()
+        metrics.set_labels(customer='bar', command='resize_then_crop')
+        metrics.observe('upload', 0.2)
+        metrics.finish_request()
+        metrics.register_gauge('prism_test_gauge', 'A test gauge.', lambda: 3)
+        text = metrics.render_prometheus()
+        self.assertIn('stage="upload",customer="bar",command="resize_then_crop",le="0.1"} 0', text)
+        self.assertIn('stage="upload",customer="bar",command="resize_then_crop",le="0.25"} 1', text)
+        self.assertIn('prism_test_gauge{worker="', text)
@@ -0,0 +1,48 @@
+import unittest
+from io import BytesIO
+
+import numpy
+from PIL import Image
+
+from prism.quality import search_quality, ssim
+
+
+class TestSsim(unittest.TestCase):
+    def test_values(self):
+        x = numpy.linspace(0, 255, 64)
+        pixels = numpy.dstack([numpy.add.outer(x, x) / 2] * 3).astype(numpy.uint8)
+        self.assertAlmostEqual(ssim(pixels, pixels), 1.0)
+        noisy = numpy.clip(pixels + numpy.random.RandomState(1).randint(-40, 40, pixels.shape), 0, 255).astype(numpy.uint8)
+        self.assertLess(ssim(pixels, noisy), 0.95)
+
+    def test_transparent_pixels_are_ignored(self):
+        a = numpy.zeros((16, 16, 4), dtype=numpy.uint8)
+        b = a.copy()
+        b[..., :3] = 255
+        self.assertAlmostEqual(ssim(a, b), 1.0)
+
+
+class TestSearchQuality(unittest.TestCase):
+    def setUp(self):
+        x = numpy.linspace(0, 255, 64)
+        self.pixels = numpy.dstack([numpy.add.outer(x, x) / 2] * 3).astype(numpy.uint8)
+        self.qualities = []
+
+    def encode(self, quality):
+        self.qualities.append(quality)
+        f = BytesIO()
+        Image.fromarray(self.pixels).save(f, 'JPEG', quality=quality)
+        return f.getvalue()
+
+    def test_lowest_quality_meeting_target(self):
+        quality, data = search_quality(self.encode, self.pixels, target=0.99, min_quality=10, max_quality=95)
+        self.assertEqual(data, self.encode(quality))
+        self.assertGreater(quality, 10)
+        self.assertLess(quality, 95)
+        # the next lower quality misses the target
+        lower = numpy.asarray(Image.open(BytesIO(self.encode(quality - 1))).convert('RGB'))
+        self.assertLess(ssim(self.pixels, lower), 0.99)
+
+    def test_time_budget(self):
+        quality, _ = search_quality(self.encode, self.pixels, target=0.99, time_budget=0)
+        self.assertEqual((quality, self.qualities), (95, [95]))
@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+import unittest
+
+import prism.metrics as metrics
+from prism.render import RenderEngine, RenderProcessError, RenderTimeoutError
+
+
+def pid(seconds=0):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def timed():
+    metrics.set_labels(backend='pillow')
+    with metrics.timer('decode'):
+        pass
+    metrics.observe_quality(72)
+    return 'ok'
+
+
+def crash():
+    os._exit(1)
+
+
+def fail():
+    raise ValueError('boom')
+
+
+class TestRenderEngine(unittest.TestCase):
+    def engine(self, **kwargs):
+        engine = RenderEngine(**kwargs)
+        self.addCleanup(engine.close)
+        return engine
+
+    def run_in_thread(self, fn, *args):
+        results = []
+
+        def target():
+            try:
+                results.append(fn(*args))
+            except Exception as e:
+                results.append(e)
+
+        t = threading.Thread(target=target)
+        t.start()
+        return t, results
+
+    def test_reuse_and_recycle(self):
+        engine = self.engine(processes=1, max_jobs=2)
+        pids = [engine.run(pid) for _ in range(3)]
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+
+    def test_exception(self):
+        engine = self.engine(processes=1)
+        first = engine.run(pid)
+        self.assertRaises(ValueError, engine.run, fail)
+        self.assertEqual(engine.run(pid), first)
+
+    def test_metrics(self):
+        engine = self.engine(processes=1)
+        metrics.start_request()
+        metrics.set_labels(customer='foo')
+        self.assertEqual(engine.run(timed), 'ok')
+        self.assertEqual(metrics.get_labels(), {'customer': 'foo', 'command': '', 'backend': 'pillow'})
+        self.assertEqual(metrics.get_qualities(), [72])
+        self.assertEqual([stage for stage, _ in metrics.finish_request()], ['decode', 'total'])
+
+    def test_timeout_kills_only_the_stuck_process(self):
+        engine = self.engine(processes=2, timeout=2)
+        # start both processes
+        threads = [self.run_in_thread(engine.run, pid, 0.5) for _ in range(2)]
+        for t, _ in threads:
+            t.join()
+        stuck, stuck_result = self.run_in_thread(engine.run, pid, 10)
+        time.sleep(0.5)
+        self.assertNotIsInstance(engine.run(pid, 1.8), Exception)
+        stuck.join()
+        self.assertIsInstance(stuck_result[0], RenderTimeoutError)
+
+    def test_waiting_is_not_timed(self):
+        engine = self.engine(processes=1, timeout=2)
+        engine.run(pid)
+        threads = [self.run_in_thread(engine.run, pid, 1.2) for _ in range(2)]
+        for t, results in threads:
+            t.join()
+            self.assertIsInstance(results[0], int)
+
+    def test_crash(self):
+        engine = self.engine(processes=2)
+        first = engine.run(pid)
+        slow, slow_result = self.run_in_thread(engine.run, pid, 1)
+        time.sleep(0.2)
+        self.assertRaises(RenderProcessError, engine.run, crash)
+        slow.join()
+        self.assertIsInstance(slow_result[0], int)
+        self.assertIn(engine.run(pid), (first, slow_result[0]))
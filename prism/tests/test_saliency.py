@@ -0,0 +1,27 @@
+import unittest
+
+import numpy
+
+from prism.saliency import best_window, saliency
+
+
+class TestSaliency(unittest.TestCase):
+    def test_detail_attracts(self):
+        pixels = numpy.full((60, 100, 3), 128, dtype=numpy.uint8)
+        pixels[20:40, 70:90] = numpy.random.RandomState(0).randint(0, 256, (20, 20, 3))
+        x, y = best_window(saliency(pixels), 40, 60)
+        self.assertEqual(y, 0)
+        self.assertTrue(50 <= x <= 60)
+
+    def test_skin_attracts(self):
+        pixels = numpy.full((100, 60, 3), 40, dtype=numpy.uint8)
+        pixels[10:30, 20:40] = (200, 146, 112)
+        attention = saliency(pixels)
+        self.assertGreater(attention[20, 30], attention[80, 30])
+        x, y = best_window(attention, 60, 40)
+        self.assertEqual(x, 0)
+        self.assertLessEqual(y, 10)
+
+    def test_uniform_is_centered(self):
+        pixels = numpy.full((50, 100, 4), 200, dtype=numpy.uint8)
+        self.assertEqual(best_window(saliency(pixels), 50, 50), (25, 0))
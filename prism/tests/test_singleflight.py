@@ -0,0 +1,57 @@
+import tempfile
+import threading
+import unittest
+
+from prism.singleflight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_coalesce(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'done'
+
+        waiting = threading.Semaphore(0)
+
+        class WaitedEvent(threading.Event):
+            def wait(self, timeout=None):
+                waiting.release()
+                return super().wait(timeout)
+
+        leader = threading.Thread(target=lambda: results.append(flight.do('key', work)))
+        leader.start()
+        started.wait(5)
+        # count the followers that are waiting for the leader
+        flight._calls['key'].done = WaitedEvent()
+        followers = [threading.Thread(target=lambda: results.append(flight.do('key', work))) for _ in range(5)]
+        for t in followers:
+            t.start()
+        for _ in followers:
+            self.assertTrue(waiting.acquire(timeout=5))
+        release.set()
+        for t in [leader] + followers:
+            t.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['done'] * 6)
+
+    def test_error(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError('boom')
+
+        self.assertRaises(ValueError, flight.do, 'key', fail)
+        self.assertEqual(flight.do('key', lambda: 'ok'), 'ok')
+
+    def test_lock_dir(self):
+        with tempfile.TemporaryDirectory() as lock_dir:
+            flight = SingleFlight(lock_dir=lock_dir)
+            self.assertEqual(flight.do('key', lambda: 'ok', recheck=lambda: True), 'ok')
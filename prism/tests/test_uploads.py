@@ -0,0 +1,37 @@
+import threading
+import unittest
+
+from prism.uploads import WriteBehindUploader
+
+
+class TestWriteBehindUploader(unittest.TestCase):
+    def test_upload(self):
+        uploader = WriteBehindUploader(threads=1, queue_size=10, retries=2, retry_backoff=0)
+        release = threading.Event()
+        done = threading.Event()
+        uploaded = []
+
+        def upload(file):
+            release.wait(5)
+            if not uploaded:
+                uploaded.append(None)
+                raise IOError('failed')
+            uploaded.append(file.read())
+            done.set()
+
+        uploader.upload('url', b'data', upload)
+        self.assertEqual(uploader.get_pending('url'), b'data')
+        release.set()
+        done.wait(5)
+        uploader._executor.shutdown(wait=True)
+        self.assertEqual(uploaded, [None, b'data'])
+        self.assertIsNone(uploader.get_pending('url'))
+
+    def test_queue_full(self):
+        uploader = WriteBehindUploader(threads=1, queue_size=1)
+        release = threading.Event()
+        uploaded = []
+        uploader.upload('a', b'a', lambda f: release.wait(5))
+        uploader.upload('b', b'b', lambda f: uploaded.append(f.read()))
+        self.assertEqual(uploaded, [b'b'])
+        release.set()
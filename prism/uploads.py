@@ -0,0 +1,61 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindUploader(object):
+    """
+    Uploads rendered images in background threads with retries.
+
+    At most `queue_size` uploads are pending at a time; when the queue is full the upload
+    is done synchronously by the caller instead. Pending uploads can be looked up by url so
+    their bytes can be served until they are in S3.
+    """
+
+    def __init__(self, threads=4, queue_size=100, retries=3, retry_backoff=0.5):
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='upload')
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def upload(self, url, data, upload_fn):
+        """
+        Calls `upload_fn(file)` with a file containing `data` in the background.
+        """
+        if not self._slots.acquire(blocking=False):
+            logger.warning("Upload queue is full, uploading %s synchronously", url)
+            upload_fn(BytesIO(data))
+            return
+        with self._lock:
+            self._pending[url] = data
+        self._executor.submit(self._upload, url, data, upload_fn)
+
+    def _upload(self, url, data, upload_fn):
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    upload_fn(BytesIO(data))
+                    return
+                except Exception:
+                    if attempt == self.retries:
+                        logger.exception("Failed to upload %s", url)
+                    else:
+                        logger.warning("Failed to upload %s, retrying", url, exc_info=True)
+                        time.sleep(self.retry_backoff * 2 ** attempt)
+        finally:
+            with self._lock:
+                if self._pending.get(url) is data:
+                    del self._pending[url]
+            self._slots.release()
+
+    def get_pending(self, url):
+        """
+        Returns the bytes of a pending upload or None.
+        """
+        return self._pending.get(url)